@@ -1,7 +1,11 @@
 # https://adventofcode.com/2019/day/2
 
+import itertools
+
 import pytest
 
+from intcode_sweep import sweep
+
 
 def next_state(mem, pos):
     op = mem[pos]
@@ -62,12 +66,24 @@ def output(mem, noun, verb):
 
 TARGET = 19690720
 
+def set_noun_verb(mem, noun_verb):
+    mem = list(mem)
+    mem[1:3] = noun_verb
+    return mem, []
+
+def run_to_end(mem, inputs):
+    return final_state(mem)
+
+def position_zero(mem):
+    return mem[0]
+
 def part2():
-    for noun in range(100):
-        for verb in range(100):
-            answer = output(INPUT, noun, verb)
-            if answer == TARGET:
-                print(f"Part 2: noun is {noun}, verb is {verb}, answer is {100*noun + verb}")
+    noun_verbs = itertools.product(range(100), range(100))
+    results = sweep(INPUT, noun_verbs, collect=position_zero, setup=set_noun_verb, run=run_to_end)
+    for (noun, verb), answer in results:
+        if answer == TARGET:
+            print(f"Part 2: noun is {noun}, verb is {verb}, answer is {100*noun + verb}")
+            break
 
 if __name__ == "__main__":
     part2()
@@ -8,9 +8,8 @@ from intcode import CagedIntCode, IntCode, program_from_file
 
 class OneOutputIntCode(CagedIntCode):
     def run_to_output(self):
-        while not self.outputs and self.step():
-            pass
-        return self.outputs[0]
+        # All the inputs have been fed in, so the first thing yielded is the output.
+        return next(self.run_gen())
 
 
 # The tests from day 5
@@ -86,30 +85,6 @@ if __name__ == "__main__":
     part1()
 
 
-class NeedInput(Exception):
-    pass
-
-class ChainableIntCode(IntCode):
-    def __init__(self, mem, inputs, outputs):
-        self.inputs = inputs
-        self.outputs = outputs
-        super().__init__(mem, input_fn=self.feed_input, output_fn=self.outputs.append)
-
-    def feed_input(self):
-        if self.inputs:
-            return self.inputs.pop(0)
-        else:
-            self.ip -= 1
-            raise NeedInput()
-
-    def run_until_blocked(self):
-        while True:
-            try:
-                if not self.step():
-                    return False
-            except NeedInput:
-                return True
-
 def cycle_pairs(seq):
     return zip(seq, seq[1:] + seq[:1])
 
@@ -117,17 +92,26 @@ def test_cycle_pairs():
     assert list(cycle_pairs([1,2,3,4])) == [(1,2), (2,3), (3,4), (4,1)]
 
 def run_looped_amplifiers(mem, phase_settings):
-    signal_buffers = [[setting] for setting in phase_settings]
-    signal_buffers[0].append(0)
+    amps = []
+    for setting in phase_settings:
+        amp = IntCode(mem).run_gen()
+        # The amplifier asks for its phase setting, then for a signal.
+        next(amp)
+        amp.send(setting)
+        amps.append(amp)
 
-    cpus = [ChainableIntCode(mem, ins, outs) for ins, outs in cycle_pairs(signal_buffers)]
+    signal = 0
     while True:
         any_halted = False
-        for cpu in cpus:
-            if not cpu.run_until_blocked():
+        for amp in amps:
+            signal = amp.send(signal)
+            # Run to the next input request, or the end.
+            try:
+                next(amp)
+            except StopIteration:
                 any_halted = True
         if any_halted:
-            return signal_buffers[0][-1]
+            return signal
 
 def looped_thruster_values(mem):
     for settings in itertools.permutations(range(5, 10)):
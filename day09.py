@@ -3,13 +3,16 @@
 import pytest
 
 from intcode import produces, program_from_file
+from intcode_memo import memo_produces
 
 if __name__ == "__main__":
-    output = produces(program_from_file("day09_input.txt"), [1])
+    output = produces(program_from_file("day09_input.txt"), [1], compiled=True)
     if len(output) > 1:
         print(f"Incorrect functioning: {output}")
     else:
         print(f"Part 1: the BOOST keycode is {output[0]}")
 
-    output = produces(program_from_file("day09_input.txt"), [2])
+    # Part 2 is a recursive function called many times with the same
+    # arguments, so remembering the calls is much faster than compiling.
+    output = memo_produces(program_from_file("day09_input.txt"), [2])
     print(f"Part 2: the coordinates of the distress signal are {output[0]}")
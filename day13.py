@@ -4,6 +4,7 @@ import time
 
 import blessings
 
+import display
 from intcode import IntCode, program_from_file
 
 class ArcadeCabinet:
@@ -25,7 +26,7 @@ class ArcadeCabinet:
         self.paddle_x = 0
 
     def input_fn(self):
-        if self.pause:
+        if self.pause and self.term:
             time.sleep(self.pause)
         if self.ball_x < self.paddle_x:
             return -1
@@ -50,18 +51,23 @@ class ArcadeCabinet:
 
     def set_score(self, score):
         self.score = score
-        with self.term.location(len(self.title), self.title_y):
-            print(f"{self.score:8d}")
+        if self.term:
+            with self.term.location(len(self.title), self.title_y):
+                print(f"{self.score:8d}")
 
     def draw_tile(self, x, y, tile):
         self.tiles[x, y] = tile
-        with self.term.location(x, y + self.start_y):
-            print(" |#_o"[tile])
+        if self.term:
+            with self.term.location(x, y + self.start_y):
+                print(" |#_o"[tile])
 
     def num_blocks(self):
         return sum(int(tile == 2) for tile in self.tiles.values())
 
     def run(self):
+        if not display.drawing():
+            self.intcode.run()
+            return
         print("\n"*60)
         self.term = blessings.Terminal()
         with self.term.hidden_cursor():
@@ -70,13 +76,108 @@ class ArcadeCabinet:
             while self.intcode.step():
                 pass
 
+
+EMPTY, WALL, BLOCK, PADDLE, BALL = range(5)
+
+class HeadlessCabinet:
+    """Play the game without drawing it, as fast as the machine can run.
+
+    Tiles are kept in a grid of bytearrays.  Rather than chasing the ball,
+    the paddle heads for where the ball will come down, predicted from its
+    last move and bouncing off the side walls.  If `score_fn` is given, it's
+    called with the score and the number of blocks left each time the score
+    changes.
+    """
+    def __init__(self, mem0=None, score_fn=None):
+        program = program_from_file("day13_input.txt")
+        if mem0 is not None:
+            program[0] = mem0
+        self.cpu = IntCode(program, self.input_fn, self.output_fn)
+        self.score_fn = score_fn
+        self.outs = []
+        self.grid = []
+        self.width = 0
+        self.blocks = 0
+        self.score = 0
+        self.ball = self.last_ball = None
+        self.paddle_x = self.paddle_y = 0
+
+    def input_fn(self):
+        target = self.landing_x()
+        return (target > self.paddle_x) - (target < self.paddle_x)
+
+    def landing_x(self):
+        """Where the ball will be when it gets down to the paddle."""
+        if self.ball is None:
+            return self.paddle_x
+        x, y = self.ball
+        if self.last_ball is None or self.last_ball[1] >= y:
+            # Not falling: stay under it.
+            return x
+        x += (x - self.last_ball[0]) * (self.paddle_y - 1 - y)
+        # Unfold the bounces off the walls at 0 and width - 1.
+        span = self.width - 3
+        if span <= 0:
+            return x
+        x = (x - 1) % (2 * span)
+        if x > span:
+            x = 2 * span - x
+        return x + 1
+
+    def output_fn(self, val):
+        self.outs.append(val)
+        if len(self.outs) == 3:
+            x, y, tile = self.outs
+            self.outs = []
+            if (x, y) == (-1, 0):
+                self.score = tile
+                if self.score_fn:
+                    self.score_fn(self.score, self.blocks)
+                return
+            self.set_tile(x, y, tile)
+            if tile == PADDLE:
+                self.paddle_x, self.paddle_y = x, y
+            elif tile == BALL:
+                self.last_ball = self.ball
+                self.ball = (x, y)
+
+    def set_tile(self, x, y, tile):
+        grid = self.grid
+        if x >= self.width:
+            self.width = x + 1
+            for row in grid:
+                row.extend(bytes(self.width - len(row)))
+        while len(grid) <= y:
+            grid.append(bytearray(self.width))
+        row = grid[y]
+        self.blocks += (tile == BLOCK) - (row[x] == BLOCK)
+        row[x] = tile
+
+    def num_blocks(self):
+        return self.blocks
+
+    def run(self):
+        self.cpu.run_compiled()
+
+
+def test_headless_cabinet():
+    cab = ArcadeCabinet(2)
+    cab.intcode.run()
+    scores = []
+    headless = HeadlessCabinet(2, lambda score, blocks: scores.append((score, blocks)))
+    headless.run()
+    assert headless.score == scores[-1][0] == cab.score
+    assert scores[-1][1] == headless.num_blocks() == 0
+
     
 if __name__ == "__main__":
-    cab = ArcadeCabinet()
+    # Watch it play on a terminal, or just get the answers.
+    Cabinet = ArcadeCabinet if display.drawing() else HeadlessCabinet
+    cab = Cabinet()
     cab.run()
     part_1 = cab.num_blocks()
 
-    cab = ArcadeCabinet(2)
+    cab = Cabinet(2)
     cab.run()
     part_2 = cab.score
 
@@ -1,11 +1,13 @@
 # https://adventofcode.com/2019/day/15
 
+import collections
 import time
 
 import attr
 import blessings
 import pytest
 
+import display
 from intcode import IntCode, program_from_file
 
 @attr.s(auto_attribs=True, frozen=True)
@@ -62,6 +64,28 @@ class Field:
     def __setitem__(self, coords, val):
         self.cells[coords] = val
 
+    def distances(self, sources):
+        """How far each reachable open cell is from the nearest of `sources`.
+
+        A breadth-first search from all of them at once.  Returns a dict
+        mapping (x, y) to distance.  Unknown cells are treated as walls.
+        """
+        dist = {source: 0 for source in sources}
+        frontier = collections.deque(dist)
+        cells = self.cells
+        while frontier:
+            x, y = here = frontier.popleft()
+            d = dist[here] + 1
+            for there in [(x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)]:
+                if there not in dist and cells.get(there) == 0:
+                    dist[there] = d
+                    frontier.append(there)
+        return dist
+
+    def flood_time(self, sources):
+        """How long until something spreading from `sources` fills every cell it can reach."""
+        return max(self.distances(sources).values())
+
     def draw(self, cell_chars='.#', draw_fn=None):
         if draw_fn is None:
             draw_fn = lambda: None
@@ -79,6 +103,19 @@ class Field:
             print()
         print("-" * 60)
 
+def test_field_distances():
+    # A loop with a tail, and a closed-off cell at (4, 0).
+    field = Field()
+    for row, line in enumerate(["...#.", ".#.##", "...##", "#.###"]):
+        for col, ch in enumerate(line):
+            field[col, row] = ".#".index(ch)
+    dist = field.distances([(0, 0)])
+    assert dist[2, 2] == 4
+    assert dist[1, 3] == 4
+    assert (4, 0) not in dist
+    assert field.flood_time([(0, 0)]) == 4
+    assert field.flood_time([(0, 0), (2, 2)]) == 2
+
 def common_head_len(seq1, seq2):
     """How long is the common head of seq1 and seq2?"""
     i = -1
@@ -97,6 +134,15 @@ def test_common_head_len(seq1, seq2, head_len):
     assert common_head_len(seq1, seq2) == head_len
 
 
+def moves_between(moves_to_point, pt1, pt2):
+    """The moves from pt1 to pt2, given the moves from the start to each."""
+    to_here = moves_to_point[pt1]
+    to_there = moves_to_point[pt2]
+    common_len = common_head_len(to_here, to_there)
+    backup = list(reversed([d.back() for d in to_here[common_len:]]))
+    return backup + to_there[common_len:]
+
+
 class Done(Exception):
     pass
 
@@ -131,9 +177,10 @@ class Robot:
         #print(f"output with state {self.state}, pos = {self.pos}, next_pos = {next_pos}")
         getattr(self, self.state + '_output')(val, next_pos)
         self.pos = next_pos
-        print("-" * 80)
-        self.draw()
-        time.sleep(.001)
+        if display.drawing():
+            print("-" * 80)
+            self.draw()
+            time.sleep(.001)
 
     def pick_a_point_input(self):
         #print(f"picking point")
@@ -150,11 +197,7 @@ class Robot:
 
     def moves_from_to(self, pt1, pt2):
         """Return the moves to get from self.pos to pt."""
-        to_here = self.moves_to_point[pt1]
-        to_there = self.moves_to_point[pt2]
-        common_len = common_head_len(to_here, to_there)
-        backup = list(reversed([d.back() for d in to_here[common_len:]]))
-        return backup + to_there[common_len:]
+        return moves_between(self.moves_to_point, pt1, pt2)
 
     def blind_move(self, moves):
         self.blind_moves = list(reversed(moves))
@@ -225,19 +268,85 @@ class Robot:
         self.tank.draw(' █', self.draw_fn)
 
     def run(self):
-        with term.fullscreen():
-            with term.hidden_cursor():
-                try:
-                    self.cpu.run()
-                except Done:
-                    pass
+        try:
+            if display.drawing():
+                with term.fullscreen():
+                    with term.hidden_cursor():
+                        self.cpu.run()
+            else:
+                self.cpu.run()
+        except Done:
+            pass
+
+
+class ForkingExplorer:
+    """Map the whole area breadth-first, from snapshots of the droid.
+
+    The droid isn't walked around.  Each open cell found keeps a fork of the
+    machine that just moved there, and trying a direction from a cell forks
+    its snapshot and moves it once, so each edge costs one move.  Cells are
+    found in order of distance, so moves_to_point has shortest paths.
+    """
+    def __init__(self):
+        program = program_from_file("day15_input.txt")
+        self.cpu = IntCode(program)
+        self.tank = Field()
+        self.tank[0, 0] = 0
+        self.oxygen_pos = None
+        self.moves_to_point = {Point(0, 0): []}
+        self.moves_tried = 0
+
+    def run(self):
+        # Run to the first input, then explore from there.
+        self.cpu.run()
+        frontier = collections.deque([(Point(0, 0), self.cpu)])
+        while frontier:
+            pos, cpu = frontier.popleft()
+            for dir, command in MOVEMENT.items():
+                next_pos = pos.move(dir)
+                if next_pos in self.moves_to_point or self.tank[next_pos.tuple()] == 1:
+                    continue
+                status = []
+                droid = cpu.fork(output_fn=status.append)
+                droid.feed([command])
+                droid.run()
+                self.moves_tried += 1
+                if status == [0]:
+                    self.tank[next_pos.tuple()] = 1
+                    continue
+                self.tank[next_pos.tuple()] = 0
+                self.moves_to_point[next_pos] = self.moves_to_point[pos] + [dir]
+                if status == [2]:
+                    self.oxygen_pos = next_pos
+                frontier.append((next_pos, droid))
+
+def test_forking_explorer():
+    # Don't draw, even under pytest -s on a terminal.
+    was_drawing = display.drawing()
+    display.set_drawing(False)
+    try:
+        robot = Robot()
+        robot.run()
+        explorer = ForkingExplorer()
+        explorer.run()
+    finally:
+        display.set_drawing(was_drawing)
+    assert explorer.tank.cells == robot.tank.cells
+    assert explorer.oxygen_pos == robot.oxygen_pos
+    assert len(explorer.moves_to_point[explorer.oxygen_pos]) == len(robot.moves_to_point[robot.oxygen_pos])
+
 
 if __name__ == "__main__":
-    robot = Robot()
-    robot.run()
-    robot.draw()
+    if display.drawing():
+        # Watch the droid find its way around.
+        robot = Robot()
+        robot.run()
+        robot.draw()
+    else:
+        robot = ForkingExplorer()
+        robot.run()
     num_moves = len(robot.moves_to_point[robot.oxygen_pos])
     print(f"Part 1: it takes {num_moves} steps to get to the oxygen")
 
-    farthest = max(len(robot.moves_from_to(robot.oxygen_pos, pt)) for pt in robot.moves_to_point)
+    farthest = robot.tank.flood_time([robot.oxygen_pos.tuple()])
     print(f"Part 2: it will take {farthest} minutes to fill with oxygen")
@@ -1,35 +1,28 @@
 # https://adventofcode.com/2019/day/17
 
-from intcode import IntCode, program_from_file
+from intcode import AsciiSink, IntCode, program_from_file
 
 
 class Camera:
     def __init__(self, mem0=None, inputs=''):
-        self.inputs = iter(inputs)
         program = program_from_file("day17_input.txt")
         if mem0 is not None:
             program[0] = mem0
-        self.cpu = IntCode(program, self.input_fn, self.output_fn)
-        self.x = self.y = 0
+        self.cpu = IntCode(program, output_fn=AsciiSink(self.see_line, self.see_dust))
+        self.cpu.feed_text(inputs)
+        self.y = 0
         self.chars = {}
         self.dust = None
 
-    def input_fn(self):
-        return ord(next(self.inputs))
-
-    def output_fn(self, val):
-        if val > 128:
-            self.dust = val
-        else:
-            ch = chr(val)
+    def see_line(self, line):
+        for x, ch in enumerate(line):
             if ch == '#':
-                self.chars[self.x, self.y] = '#'
-            if ch == '\n':
-                self.x = 0
-                self.y += 1
-            else:
-                self.x += 1
-            print(ch, end='')
+                self.chars[x, self.y] = '#'
+        self.y += 1
+        print(line, end='')
+
+    def see_dust(self, val):
+        self.dust = val
 
     def intersections(self):
         for (x, y), ch in self.chars.items():
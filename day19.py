@@ -6,13 +6,14 @@ import sys
 import pytest
 
 from intcode import IntCode, program_from_file
+from intcode_batch import BatchIntCode
 
 class BeamScan:
     program = program_from_file("day19_input.txt")
 
     def __init__(self, x, y):
-        self.inputs = iter([x, y])
-        self.cpu = IntCode(self.program, lambda: next(self.inputs), self.output_fn)
+        self.cpu = IntCode(self.program, output_fn=self.output_fn)
+        self.cpu.feed([x, y])
         self.affected = 0
 
     def output_fn(self, val):
@@ -24,9 +25,13 @@ def probe(x, y):
     return scanner.affected
 
 def scan(ux, uy):
+    coords = list(itertools.product(range(uy), range(ux)))
+    # Probe all the points at once.
+    batch = BatchIntCode(BeamScan.program, [(x, y) for y, x in coords])
+    batch.run()
     points = 0
-    for y, x in itertools.product(range(uy), range(ux)):
-        yes = probe(x, y)
+    for (y, x), outputs in zip(coords, batch.outputs):
+        yes = outputs[0]
         print(".#"[yes], end=('\n' if x == ux-1 else ''))
         points += yes
     return points
@@ -1,27 +1,23 @@
 # https://adventofcode.com/2019/day/21
 
-from intcode import IntCode, program_from_file
+from intcode import AsciiSink, IntCode, program_from_file
 
 class AsciiComputer:
     def __init__(self, program, label, input):
-        self.cpu = IntCode(program, self.input_fn, self.output_fn)
+        self.cpu = IntCode(program, self.input_fn, AsciiSink(self.print_line, self.print_damage))
         self.label = label
-        self.input = []
-        self.store_input(input)
-    
-    def store_input(self, text):
-        self.input = list(reversed(text))
+        self.cpu.feed_text(input)
 
     def input_fn(self):
-        if not self.input:
-            self.store_input(input("") + "\n")
-        return ord(self.input.pop())
+        # Out of springscript: ask for more.
+        self.cpu.feed_text(input("") + "\n")
+        return self.cpu.pending.popleft()
 
-    def output_fn(self, val):
-        if 0 <= val < 128:
-            print(chr(val), end='', flush=True)
-        else:
-            print(f"{self.label}: hull damage is: {val}")
+    def print_line(self, line):
+        print(line, end='', flush=True)
+
+    def print_damage(self, val):
+        print(f"{self.label}: hull damage is: {val}")
 
     def run(self):
         print(f"--- {self.label} ---------")
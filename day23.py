@@ -1,14 +1,21 @@
 # https://adventofcode.com/2019/day/23
 
+import asyncio
 import collections
 import contextlib
-import random
+import multiprocessing
+import os
+import struct
+import sys
 import time
+from multiprocessing import shared_memory
 
 import blessings
 
+import display
 from astar import OnceEvery
-from intcode import IntCode, program_from_file
+from intcode import IntCode, Scheduler, need_input, program_from_file
+from intcode_async import AsyncIntCode
 
 class Nic:
     def __init__(self, network, program, number):
@@ -16,6 +23,8 @@ class Nic:
         self.cpu = IntCode(program, self.input_fn, self.output_fn)
         self.number = number
         self.output = []
+        # Has it been told once that there's nothing for it?
+        self.polled = False
 
     def input_fn(self):
         return self.network.get_input(self.number)
@@ -35,6 +44,9 @@ BOTTOM_LINE = 51
 
 @contextlib.contextmanager
 def terminal():
+    if not display.drawing():
+        yield None
+        return
     term = blessings.Terminal()
     print(term.clear())
     try:
@@ -44,30 +56,46 @@ def terminal():
         print(term.move(BOTTOM_LINE+2, 0))
 
 class Network:
-    def __init__(self):
+    def __init__(self, numbers=range(50)):
         program = program_from_file("day23_input.txt")
-        self.nics = [Nic(self, list(program), num) for num in range(50)]
-        self.queues = [collections.deque([num]) for num in range(50)]
+        self.nics = {num: Nic(self, list(program), num) for num in numbers}
+        self.queues = {num: collections.deque([num]) for num in numbers}
         self.idle_nics = set()
         self.packet_history = []
         self.packet255 = None
         self.packet255_history = []
+        self.term = None
+        self.scheduler = None
 
     def is_idle(self):
-        return all(not q for q in self.queues) and len(self.idle_nics) == 50
+        # NICs only wait with empty queues, and a packet wakes them.
+        return len(self.idle_nics) == len(self.nics)
 
     def get_input(self, num):
+        nic = self.nics[num]
         if self.queues[num]:
             val = self.queues[num].pop()
             self.draw_queue(num)
-            if num in self.idle_nics:
-                self.idle_nics.remove(num)
+            nic.polled = False
             return val
-        else:
-            self.idle_nics.add(num)
+        if not nic.polled:
+            # Let the NIC see once that there's nothing for it.
+            nic.polled = True
             return -1
+        # Then it waits, blocked, until a packet arrives.
+        self.idle_nics.add(num)
+        need_input()
+
+    def say(self, line, text):
+        if self.term:
+            with self.term.location(0, line):
+                print(text)
+        else:
+            print(text)
 
     def draw_list(self, vals, column, width):
+        if not self.term:
+            return
         head = max(len(vals) - 50, 0)
         for i, packet in enumerate(vals[-50:]):
             with self.term.location(column, i):
@@ -77,31 +105,42 @@ class Network:
         self.packet_history.append((nic, x, y))
         if nic == 255:
             if not self.packet255:
-                with self.term.location(0, BOTTOM_LINE):
-                    print(f"Part 1: Packet 255 has y value of {y}")
+                self.say(BOTTOM_LINE, f"Part 1: Packet 255 has y value of {y}")
             self.packet255 = (x, y)
         else:
-            self.queues[nic].extendleft([x, y])
-            self.draw_queue(nic)
+            self.deliver(nic, x, y)
             self.draw_list(self.packet_history, PACKET_COLUMN, PACKET_WIDTH)
 
+    def deliver(self, nic, x, y):
+        self.queues[nic].extendleft([x, y])
+        if nic in self.idle_nics:
+            self.idle_nics.remove(nic)
+            self.scheduler.wake(self.nics[nic].cpu)
+        self.draw_queue(nic)
+
     def draw_queue(self, num):
+        if not self.term:
+            return
         queuestr = " ".join(str(val) for val in self.queues[num])
         queuestr = queuestr[-Q_COLUMN:].rjust(Q_COLUMN)
         with self.term.location(0, num):
             print(queuestr)
 
-    def step_one(self, num):
-        self.nics[num].cpu.step()
-
     def draw_cpu(self, num):
+        if not self.term:
+            return
         nic = self.nics[num]
         with self.term.location(CPU_COLUMN, num):
             idle = '-' if (num in self.idle_nics) else ' '
             print(f"| {nic.number:3d}{idle} {nic.cpu.steps}")
 
+    # The most instructions a NIC runs before the next one gets a turn.
+    # Mostly they run until they're waiting for a packet.
+    QUANTUM = 10_000
+
     def run(self):
         should_log = OnceEvery(seconds=.25)
+        self.scheduler = scheduler = Scheduler([nic.cpu for nic in self.nics.values()], quantum=self.QUANTUM)
         with terminal() as self.term:
             for num in range(50):
                 self.draw_queue(num)
@@ -112,15 +151,312 @@ class Network:
                     p255h.append(self.packet255)
                     self.draw_list(p255h, PACKET255_COLUMN, PACKET_WIDTH)
                     if len(p255h) >= 2 and p255h[-1][1] == p255h[-2][1]:
-                        with self.term.location(0, BOTTOM_LINE+1):
-                            print(f"Part 2: the first y value delivered twice in a row is {p255h[-1][1]}")
-                        break
-                self.step_one(random.randrange(50))
+                        self.say(BOTTOM_LINE+1, f"Part 2: the first y value delivered twice in a row is {p255h[-1][1]}")
+                        return p255h[-1][1]
+                scheduler.run_round()
                 if should_log.now():
                     for num in range(50):
                         self.draw_queue(num)
                         self.draw_cpu(num)
 
+
+class AsyncNic(AsyncIntCode):
+    def __init__(self, network, program, number):
+        super().__init__(program)
+        self.network = network
+        self.number = number
+        self.inputs.put_nowait(number)
+        self.packet = []
+        self.polled = False
+
+    async def get_input(self):
+        if self.inputs.empty():
+            if not self.polled:
+                # Let the NIC see once that there's nothing for it.
+                self.polled = True
+                return -1
+            # Then wait for a packet.
+            self.network.went_idle()
+            value = await self.inputs.get()
+            self.network.idle -= 1
+        else:
+            value = self.inputs.get_nowait()
+        self.polled = False
+        return value
+
+    async def put_output(self, value):
+        self.packet.append(value)
+        if len(self.packet) == 3:
+            self.network.send_packet(*self.packet)
+            self.packet = []
+
+class AsyncNetwork:
+    """The network, with each NIC as an asyncio task that waits for packets."""
+    def __init__(self, size=50):
+        program = program_from_file("day23_input.txt")
+        self.nics = [AsyncNic(self, program, num) for num in range(size)]
+        self.idle = 0
+        self.all_idle = asyncio.Event()
+        self.packet255 = None
+        self.y255s = []
+
+    def went_idle(self):
+        self.idle += 1
+        if self.idle == len(self.nics) and all(nic.inputs.empty() for nic in self.nics):
+            self.all_idle.set()
+
+    def send_packet(self, nic, x, y):
+        if nic == 255:
+            if not self.packet255:
+                print(f"Part 1: Packet 255 has y value of {y}")
+            self.packet255 = (x, y)
+        else:
+            self.nics[nic].inputs.put_nowait(x)
+            self.nics[nic].inputs.put_nowait(y)
+
+    async def nat(self):
+        """Wait for the network to go idle, then wake NIC 0 with the last 255 packet."""
+        while True:
+            await self.all_idle.wait()
+            self.all_idle.clear()
+            x, y = self.packet255
+            self.y255s.append(y)
+            if len(self.y255s) >= 2 and self.y255s[-1] == self.y255s[-2]:
+                return y
+            self.send_packet(0, x, y)
+
+    async def run(self):
+        tasks = [asyncio.create_task(nic.run_async()) for nic in self.nics]
+        y = await self.nat()
+        for task in tasks:
+            task.cancel()
+        print(f"Part 2: the first y value delivered twice in a row is {y}")
+        return y
+
+
+class PacketRing:
+    """A ring buffer of packets in shared memory, for one writer and one reader.
+
+    The writer only changes the tail count and the reader only changes the
+    head count, so no lock is needed.  Packets are (address, x, y), which
+    must fit in 64 bits.
+    """
+    HEADER = struct.Struct("<qq")
+    PACKET = struct.Struct("<qqq")
+
+    def __init__(self, buf, capacity):
+        self.buf = buf
+        self.capacity = capacity
+
+    @classmethod
+    def size(cls, capacity):
+        return cls.HEADER.size + capacity * cls.PACKET.size
+
+    def put(self, packet):
+        """Add a packet, or return False if the ring is full."""
+        head, tail = self.HEADER.unpack_from(self.buf, 0)
+        if tail - head == self.capacity:
+            return False
+        self.PACKET.pack_into(self.buf, self.HEADER.size + (tail % self.capacity) * self.PACKET.size, *packet)
+        struct.pack_into("<q", self.buf, 8, tail + 1)
+        return True
+
+    def take(self):
+        """Remove and return all the packets."""
+        head, tail = self.HEADER.unpack_from(self.buf, 0)
+        packets = [
+            self.PACKET.unpack_from(self.buf, self.HEADER.size + (i % self.capacity) * self.PACKET.size)
+            for i in range(head, tail)
+        ]
+        struct.pack_into("<q", self.buf, 0, tail)
+        return packets
+
+
+def shard_of(nic, nshards, size):
+    """Which shard has NIC `nic`.  The coordinator, number `nshards`, is the NAT."""
+    return nic * nshards // size if nic < size else nshards
+
+
+class Shard(Network):
+    """Some of the NICs of a ShardedNetwork, run in a worker process.
+
+    Packets for NICs in other shards, or for the NAT, go into rings.  If a
+    ring is full, they wait here for the next round.  `sent` counts the
+    packets sent, so the coordinator can tell when nothing is moving.
+    """
+    def __init__(self, numbers, nshards, size, outboxes):
+        super().__init__(numbers)
+        self.nshards = nshards
+        self.size = size
+        self.outboxes = outboxes
+        self.overflow = collections.deque()
+        self.sent = 0
+        self.scheduler = Scheduler([nic.cpu for nic in self.nics.values()], quantum=self.QUANTUM)
+
+    def send_packet(self, nic, x, y):
+        if nic in self.nics:
+            self.deliver(nic, x, y)
+        else:
+            self.sent += 1
+            self.overflow.append((nic, x, y))
+            self.flush()
+
+    def flush(self):
+        """Put waiting packets into the rings, as long as they fit."""
+        overflow = self.overflow
+        while overflow:
+            packet = overflow[0]
+            if not self.outboxes[shard_of(packet[0], self.nshards, self.size)].put(packet):
+                break
+            overflow.popleft()
+
+    def run_round(self, inboxes):
+        """Take the packets sent to us, and run until every NIC is waiting."""
+        for inbox in inboxes:
+            for packet in inbox.take():
+                self.deliver(*packet)
+        self.flush()
+        self.scheduler.run()
+        if self.overflow:
+            # Packets still waiting for room mean we aren't idle.
+            self.sent += 1
+
+
+def run_shard(shard, nshards, size, buf, barrier):
+    """The worker process for one shard: run rounds until told to stop."""
+    try:
+        control, rings = ShardedNetwork.layout(buf, nshards)
+        numbers = [nic for nic in range(size) if shard_of(nic, nshards, size) == shard]
+        net = Shard(numbers, nshards, size, rings[shard])
+        inboxes = [row[shard] for row in rings]
+        while True:
+            barrier.wait()
+            if control[0]:
+                break
+            net.run_round(inboxes)
+            control[1 + shard] = net.sent
+            barrier.wait()
+    except BaseException:
+        # Don't leave the others waiting at the barrier.
+        barrier.abort()
+        raise
+
+
+class ShardedNetwork:
+    """The network, with its NICs spread over worker processes.
+
+    Each worker runs a Shard, and they all run in rounds, separated by a
+    barrier.  In a round, each shard takes the packets sent to it, then runs
+    its NICs until they're all waiting for packets.  This process is the
+    NAT: if no packet was sent in a round, every NIC is waiting and no
+    packet is on its way, so the network is idle, just as in Network.
+
+    Packets go through a PacketRing in shared memory for each sender and
+    receiver, with this process as number `nshards`.  The workers are
+    forked, so they inherit the shared memory rather than attaching to it.
+    """
+    RING_CAPACITY = 4096
+
+    def __init__(self, nshards=None, size=50):
+        self.nshards = nshards or os.cpu_count()
+        self.size = size
+        self.packet255 = None
+        self.y255s = []
+        self.rounds = 0
+
+    @classmethod
+    def layout(cls, buf, nshards):
+        """The control words and the rings in the shared memory `buf`.
+
+        The control words are a stop flag, then each shard's count of
+        packets sent.  rings[src][dest] carries packets from src to dest.
+        """
+        control_size = (nshards + 1) * 8
+        ring_size = PacketRing.size(cls.RING_CAPACITY)
+        n = nshards + 1
+        control = buf[:control_size].cast("q")
+        rings = [
+            [
+                PacketRing(buf[(start := control_size + (src * n + dest) * ring_size):start + ring_size], cls.RING_CAPACITY)
+                for dest in range(n)
+            ]
+            for src in range(n)
+        ]
+        return control, rings
+
+    def run(self):
+        nshards = self.nshards
+        n = nshards + 1
+        shm = shared_memory.SharedMemory(create=True, size=n * 8 + n * n * PacketRing.size(self.RING_CAPACITY))
+        shm.buf[:] = bytes(shm.size)
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(n)
+        workers = [
+            context.Process(target=run_shard, args=(shard, nshards, self.size, shm.buf, barrier))
+            for shard in range(nshards)
+        ]
+        for worker in workers:
+            worker.start()
+        control, rings = self.layout(shm.buf, nshards)
+        try:
+            y = self.coordinate(control, rings, barrier)
+        except BaseException:
+            barrier.abort()
+            raise
+        finally:
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+            del control, rings
+            shm.close()
+            shm.unlink()
+        print(f"Part 2: the first y value delivered twice in a row is {y}")
+        return y
+
+    def coordinate(self, control, rings, barrier):
+        """Run rounds, as the NAT, until it's done.  Returns the part 2 answer."""
+        nshards = self.nshards
+        nat_ring = rings[nshards][shard_of(0, nshards, self.size)]
+        last_sent = 0
+        while True:
+            barrier.wait()
+            barrier.wait()
+            self.rounds += 1
+            for row in rings[:nshards]:
+                for _, x, y in row[nshards].take():
+                    if not self.packet255:
+                        print(f"Part 1: Packet 255 has y value of {y}")
+                    self.packet255 = (x, y)
+            sent = sum(control[1:])
+            if sent == last_sent:
+                # Idle: wake NIC 0 with the last packet the NAT got.
+                x, y = self.packet255
+                self.y255s.append(y)
+                if len(self.y255s) >= 2 and self.y255s[-1] == self.y255s[-2]:
+                    control[0] = 1
+                    barrier.wait()
+                    return y
+                nat_ring.put((0, x, y))
+            last_sent = sent
+
+def test_networks_agree():
+    # Don't draw, even under pytest -s on a terminal.
+    was_drawing = display.drawing()
+    display.set_drawing(False)
+    try:
+        y = Network().run()
+        assert asyncio.run(AsyncNetwork().run()) == y
+        assert ShardedNetwork(nshards=3).run() == y
+    finally:
+        display.set_drawing(was_drawing)
+
 if __name__ == '__main__':
-    network = Network()
-    network.run()
+    if sys.argv[1:] == ["async"]:
+        asyncio.run(AsyncNetwork().run())
+    elif sys.argv[1:2] == ["sharded"]:
+        # python day23.py sharded [number of worker processes]
+        ShardedNetwork(*[int(arg) for arg in sys.argv[2:3]]).run()
+    else:
+        network = Network()
+        network.run()
@@ -1,38 +1,46 @@
 # https://adventofcode.com/2019/day/25
 
+import copy
 import itertools
 import re
 
-from intcode import IntCode, program_from_file
+from intcode import AsciiSink, IntCode, Status, program_from_file
 
 import pytest
 
 class Day25Computer:
+    # How long to let the program run between commands.
     MAX_STEPS = 1_000_000
 
     def __init__(self):
         program = program_from_file("day25_input.txt")
-        self.cpu = IntCode(program, self.input_fn, self.output_fn)
-        self.input = []
-        self.output = ""
-        self.done = False
-    
-    def input_fn(self):
-        if not self.input:
-            command = self.command_fn(self.output)
-            self.output = ""
-            self.input = ["\n"]
-            self.input.extend(reversed(command))
-        return ord(self.input.pop())
-
-    def output_fn(self, val):
-        self.output += chr(val)
+        self.output = AsciiSink()
+        self.cpu = IntCode(program, output_fn=self.output)
+        self.status = None
 
     def run(self):
-        while not self.done and self.cpu.steps < self.MAX_STEPS:
-            if not self.cpu.step():
+        """Run, asking command_fn for a command at each prompt.
+
+        Stops when the program does, or runs too long, or command_fn returns
+        None, which leaves the computer waiting at the prompt.
+        """
+        while True:
+            self.status = self.cpu.run_compiled(max_steps=self.MAX_STEPS)
+            if self.status is not Status.BLOCKED:
+                break
+            # The text is kept until there's a command, in case we pause here.
+            command = self.command_fn(self.output.text.decode("ascii"))
+            if command is None:
                 break
-        self.done = True
+            self.output.text.clear()
+            self.cpu.feed_text(command + "\n")
+
+    def fork(self):
+        """Make an independent copy of this computer, in its current state."""
+        other = copy.copy(self)
+        other.output = self.output.copy()
+        other.cpu = self.cpu.fork(output_fn=other.output)
+        return other
 
 
 def parse_text(text):
@@ -139,15 +147,23 @@ class FixedCommandsComputer(Day25Computer):
             self.commands = self.commands[1:]
             return command
         else:
-            data = parse_text(text)
-            self.data = data
-            self.done = True
-            return "inv"
+            self.data = parse_text(text)
+            return None
 
-def room_at_end_of_path(path):
+    def then(self, commands):
+        """Run more commands on a copy of this computer, which is left as it was."""
+        comp = self.fork()
+        comp.commands = commands
+        comp.run()
+        return comp
+
+def room_computer(path):
     comp = FixedCommandsComputer(path)
     comp.run()
-    return comp.data
+    return comp
+
+def room_at_end_of_path(path):
+    return room_computer(path).data
 
 @pytest.mark.parametrize("path, room", [
     ([], "Hull Breach"),
@@ -158,8 +174,15 @@ def test_room_at_end_of_path(path, room):
     assert room_at_end_of_path(path)['room'] == room
 
 def map_rooms():
-    start = room_at_end_of_path([])
+    """Explore the ship.
+
+    Each room's data includes a 'computer' waiting at that room's prompt, so
+    that exploring onward doesn't have to replay the path from the start.
+    """
+    comp = room_computer([])
+    start = comp.data
     start['path'] = []
+    start['computer'] = comp
     # map room names to data about the room.
     rooms = {start['room']: start}
     edge = set([start['room']])
@@ -169,11 +192,13 @@ def map_rooms():
             room = rooms[room_name]
             for door in room['doors']:
                 npath = room['path'] + [door]
-                next_room = room_at_end_of_path(npath)
+                next_comp = room['computer'].then([door])
+                next_room = next_comp.data
                 if next_room['state'] == 'weighed':
                     next_room['doors'] = next_room['items'] = []
                 if next_room['room'] not in rooms:
                     next_room['path'] = npath
+                    next_room['computer'] = next_comp
                     next_edge.add(next_room['room'])
                     rooms[next_room['room']] = next_room
         edge = next_edge
@@ -189,11 +214,7 @@ def item_map(rooms):
 def takable_items(rooms, items):
     takable = {}
     for item, in_room in items.items():
-        commands = []
-        commands += rooms[in_room]['path']
-        commands += [f"take {item}", f"drop {item}"] 
-        comp = FixedCommandsComputer(commands)
-        comp.run()
+        comp = rooms[in_room]['computer'].then([f"take {item}", f"drop {item}"])
         data = comp.data
         if data['state'] == 'dropped':
             takable[item] = in_room
@@ -231,21 +252,32 @@ def navigate(from_room, to_room):
     return back_to_common + tpath[head:]
 
 
-def weigh_items(rooms, items, to_take):
-    at = next(room for room in rooms.values() if room['path'] == [])
+def ready_to_weigh(rooms, items):
+    """Pick up all the items, and go to the room before the pressure-sensitive floor.
+
+    Returns the waiting computer, and the door to the floor.
+    """
+    start = next(room for room in rooms.values() if room['path'] == [])
     finish = next(room for room in rooms.values() if room['state'] == 'weighed')
+    checkpoint = next(room for room in rooms.values() if room['path'] == finish['path'][:-1])
+    at = start
     commands = []
-    for item in to_take:
-        item_room = rooms[items[item]]
+    for item, in_room in items.items():
+        item_room = rooms[in_room]
         commands += navigate(at, item_room)
-        commands += [f"take {item}"] 
+        commands += [f"take {item}"]
         at = item_room
-    commands += navigate(at, finish)
-    comp = FixedCommandsComputer(commands)
-    comp.run()
+    commands += navigate(at, checkpoint)
+    return start['computer'].then(commands), finish['path'][-1]
+
+def weigh_items(ready, items, to_take):
+    comp, door = ready
+    commands = [f"drop {item}" for item in items if item not in to_take]
+    commands += [door]
+    comp = comp.then(commands)
     data = comp.data
     if 'weight' not in data:
-        return comp.output
+        return comp.output.take()
 
 def powerset(iterable):
     "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
@@ -259,8 +291,9 @@ if 1 and __name__ == "__main__":
     rooms = map_rooms()
     items = item_map(rooms)
     items = takable_items(rooms, items)
+    ready = ready_to_weigh(rooms, items)
     for to_take in powerset(items):
-        data = weigh_items(rooms, items, to_take)
+        data = weigh_items(ready, items, to_take)
         if data is not None:
             print(data)
             break
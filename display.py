@@ -0,0 +1,16 @@
+# Whether solutions draw what they're doing on the terminal.
+
+import os
+import sys
+
+# Drawing (and the pauses that make it watchable) is on when stdout is a
+# terminal, unless HEADLESS is set in the environment.  Without it, the
+# solutions keep the same state, they just don't show it.
+DRAW = sys.stdout.isatty() and not os.environ.get("HEADLESS")
+
+def drawing():
+    return DRAW
+
+def set_drawing(on):
+    global DRAW
+    DRAW = on
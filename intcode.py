@@ -1,5 +1,13 @@
 # IntCode implementation.
 
+import array
+import collections
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import zlib
 from enum import Enum
 
 import pytest
@@ -22,95 +30,819 @@ class Mode(Enum):
     IMMEDIATE = 1
     RELATIVE = 2
 
+# Plain ints for the modes, so the hot path never builds an Enum.
+POSITION = Mode.POSITION.value
+IMMEDIATE = Mode.IMMEDIATE.value
+RELATIVE = Mode.RELATIVE.value
+
+# The number of parameters, and the name of the IntCode method that runs it.
+OPS = {
+    Op.ADD: (3, "do_add"),
+    Op.MUL: (3, "do_mul"),
+    Op.INPUT: (1, "do_input"),
+    Op.OUTPUT: (1, "do_output"),
+    Op.JUMP_IF_TRUE: (2, "do_jump_if_true"),
+    Op.JUMP_IF_FALSE: (2, "do_jump_if_false"),
+    Op.LESS_THAN: (3, "do_less_than"),
+    Op.EQUALS: (3, "do_equals"),
+    Op.ADJREL: (1, "do_adjrel"),
+    Op.STOP: (0, "do_stop"),
+}
+
+# The same, by opcode number, so decoding doesn't have to build an Op.
+OPS_BY_CODE = {op.value: (op, nparams, name) for op, (nparams, name) in OPS.items()}
+
+# The operations whose last parameter is written to.
+WRITE_OPS = {Op.ADD, Op.MUL, Op.INPUT, Op.LESS_THAN, Op.EQUALS}
+
+class Status(Enum):
+    """Why run() returned."""
+    HALTED = "halted"       # The program stopped.
+    BLOCKED = "blocked"     # The program needs input, and there's none.
+    BUDGET = "budget"       # The program ran as many steps as it was allowed.
+
+class NeedInput(Exception):
+    """Raised when a machine with no input function needs input."""
+
+def need_input():
+    raise NeedInput()
+
+# A decoded instruction.  `params` is a tuple of (mode, value) pairs, and
+# `handler` is the unbound IntCode method to call with them.
+Instruction = collections.namedtuple("Instruction", "op, modes, params, handler, size")
+
+
+class Memory:
+    """IntCode memory.
+
+    The program image is a plain list.  Writes just past it grow the list a
+    page at a time, so a stack placed after the program stays contiguous.
+    Addresses farther away live in fixed-size pages of zeros, allocated the
+    first time they are written.
+
+    fork() makes a copy that shares the list and pages copy-on-write: each
+    side copies a shared piece the first time it writes to it.
+    """
+    PAGE_BITS = 10
+    PAGE_SIZE = 1 << PAGE_BITS
+    # How far past the program image the contiguous list can grow.
+    NEAR_SIZE = 64 * PAGE_SIZE
+    # Whether values are stored as 64-bit ints.  See Int64Memory.
+    typed = False
+
+    def __init__(self, image):
+        self.image = self.new_storage(image)
+        self.size = len(self.image)
+        self.far = self.size + self.NEAR_SIZE
+        self.pages = {}
+        self.image_owned = True
+        self.owned_pages = set()
+
+    def fork(self):
+        """Make an independent copy of this memory, sharing storage until written."""
+        other = object.__new__(type(self))
+        other.typed = self.typed
+        other.image = self.image
+        other.size = self.size
+        other.far = self.far
+        other.pages = dict(self.pages)
+        self.image_owned = other.image_owned = False
+        self.owned_pages = set()
+        other.owned_pages = set()
+        return other
+
+    def get_state(self):
+        """The contents as plain data: the list, where far addresses start, and the pages."""
+        return self.image, self.far, self.pages
+
+    @classmethod
+    def from_state(cls, state):
+        """Make a Memory from what get_state() returned."""
+        image, far, pages = state
+        mem = cls(image)
+        mem.far = far
+        mem.pages = {pageno: mem.new_storage(page) for pageno, page in pages.items()}
+        mem.owned_pages = set(mem.pages)
+        return mem
+
+    def new_storage(self, values):
+        """A new list for the image or a page, holding `values`."""
+        return list(values)
+
+    def promote(self):
+        """Make sure any value can be stored.  Only Int64Memory needs to."""
+
+    def __getitem__(self, addr):
+        if 0 <= addr < self.size:
+            return self.image[addr]
+        if self.size <= addr < self.far:
+            return 0
+        page = self.pages.get(addr >> self.PAGE_BITS)
+        if page is None:
+            return 0
+        return page[addr & (self.PAGE_SIZE - 1)]
+
+    def own_image(self):
+        """Make sure the list isn't shared with a fork, so it can be written."""
+        if not self.image_owned:
+            self.image = self.new_storage(self.image)
+            self.image_owned = True
+
+    def __setitem__(self, addr, value):
+        if not self.image_owned and 0 <= addr < self.far:
+            self.own_image()
+        if 0 <= addr < self.size:
+            self.image[addr] = value
+        elif self.size <= addr < self.far:
+            grow = (addr - self.size) // self.PAGE_SIZE + 1
+            self.image.extend([0] * (grow * self.PAGE_SIZE))
+            self.size = len(self.image)
+            self.image[addr] = value
+        else:
+            pageno = addr >> self.PAGE_BITS
+            if pageno not in self.owned_pages:
+                page = self.pages.get(pageno)
+                self.pages[pageno] = self.new_storage(page or [0] * self.PAGE_SIZE)
+                self.owned_pages.add(pageno)
+            page = self.pages[pageno]
+            page[addr & (self.PAGE_SIZE - 1)] = value
+
+    def __len__(self):
+        """One more than the highest address with a non-zero value.
+
+        This is never less than the size of the original program.
+        """
+        top = self.far - self.NEAR_SIZE
+        for offset in range(self.size - 1, top - 1, -1):
+            if self.image[offset]:
+                top = offset + 1
+                break
+        for pageno, page in self.pages.items():
+            base = pageno << self.PAGE_BITS
+            for offset in range(self.PAGE_SIZE - 1, -1, -1):
+                if page[offset]:
+                    top = max(top, base + offset + 1)
+                    break
+        return top
+
+    def dump(self, addrs):
+        """Get the values at all of the addresses in `addrs`, as a list."""
+        if isinstance(addrs, range) and addrs.step == 1 and 0 <= addrs.start and addrs.stop <= self.size:
+            return self.image[addrs.start:addrs.stop]
+        return [self[addr] for addr in addrs]
+
+
+class Int64Memory(Memory):
+    """IntCode memory that stores values as 64-bit ints.
+
+    The image and pages are array("q")s, a quarter of the size of lists of
+    ints.  Writing a value that doesn't fit promotes the whole memory to
+    lists, so it behaves exactly like Memory, just not as compactly.
+    Writing into the arrays directly raises OverflowError for those values:
+    catch it and write through __setitem__, which promotes.
+    """
+    def __init__(self, image):
+        try:
+            image = array.array("q", image)
+            self.typed = True
+        except OverflowError:
+            self.typed = False
+        super().__init__(image)
+
+    def new_storage(self, values):
+        if self.typed:
+            return array.array("q", values)
+        return list(values)
+
+    def promote(self):
+        if self.typed:
+            self.typed = False
+            self.image = list(self.image)
+            self.image_owned = True
+            self.pages = {pageno: list(page) for pageno, page in self.pages.items()}
+            self.owned_pages = set(self.pages)
+
+    def __setitem__(self, addr, value):
+        try:
+            super().__setitem__(addr, value)
+        except OverflowError:
+            self.promote()
+            super().__setitem__(addr, value)
+
+    def dump(self, addrs):
+        return list(super().dump(addrs))
+
+
 class IntCode:
-    def __init__(self, mem, input_fn=None, output_fn=print):
+    def __init__(self, mem, input_fn=None, output_fn=print, typed=False):
         self.ip = 0
         self.relbase = 0
-        self.mem = dict(enumerate(mem))
-        self.input_fn = input_fn
+        # Typed memory stores 64-bit ints compactly, until a bigger value
+        # is written.
+        self.mem = (Int64Memory if typed else Memory)(mem)
+        # With no input function, the machine blocks when it runs out of fed input.
+        self.input_fn = input_fn or need_input
         self.output_fn = output_fn
         self.stopped = False
         self.steps = 0
+        # Input values given with feed(), used before asking input_fn.
+        self.pending = collections.deque()
+        # Decoded instructions by address, and the addresses each one covers.
+        self.decoded = {}
+        self.decoded_at = {}
+        # Compiled blocks by starting address, the blocks each decoded
+        # instruction is part of, and how often compiled instructions have
+        # been overwritten.  See run_compiled().
+        self.blocks = {}
+        self.blocks_with = {}
+        self.rewrites = {}
 
     def __getitem__(self, addr):
-        return self.mem.get(addr, 0)
+        return self.mem[addr]
+
+    def feed(self, values):
+        """Queue up input values, to be read before calling input_fn."""
+        self.pending.extend(values)
 
-    def next_instruction(self):
-        inst = self[self.ip]
-        self.ip += 1
+    def feed_text(self, text):
+        """Queue up ASCII text as input."""
+        self.pending.extend(text.encode("ascii"))
+
+    def fork(self, input_fn=None, output_fn=None):
+        """Make an independent copy of this machine in its current state.
+
+        Memory is shared copy-on-write, so this is cheap even for a machine
+        that has run for a long time.  The copy uses the same input and output
+        functions unless new ones are provided.  Subclasses with state of their
+        own should extend this to copy it.
+        """
+        # Copy attributes by name: copy.copy() would read self.__dict__, which
+        # makes attribute access slower from then on.
+        other = object.__new__(type(self))
+        other.ip = self.ip
+        other.relbase = self.relbase
+        other.mem = self.mem.fork()
+        other.input_fn = input_fn or self.input_fn
+        other.output_fn = output_fn or self.output_fn
+        other.stopped = self.stopped
+        other.steps = self.steps
+        other.pending = collections.deque(self.pending)
+        other.decoded = dict(self.decoded)
+        other.decoded_at = dict(self.decoded_at)
+        other.blocks = dict(self.blocks)
+        other.blocks_with = dict(self.blocks_with)
+        # Which instructions get overwritten is a property of the program, so
+        # forks share what they learn about it.
+        other.rewrites = self.rewrites
+        return other
+
+    # Saved machines start with a header: magic and format version.  The
+    # rest is the zlib-compressed pickle of get_state().
+    SAVE_HEADER = struct.Struct("<8sH")
+    SAVE_MAGIC = b"INTCODES"
+    SAVE_VERSION = 1
+
+    def get_state(self):
+        """The machine's state as plain data, for save().
+
+        Subclasses with state of their own, like pending input or output,
+        should extend this and set_state().
+        """
+        return {
+            "ip": self.ip,
+            "relbase": self.relbase,
+            "stopped": self.stopped,
+            "steps": self.steps,
+            "pending": list(self.pending),
+            "typed": self.mem.typed,
+            "mem": self.mem.get_state(),
+        }
+
+    def set_state(self, state):
+        self.ip = state["ip"]
+        self.relbase = state["relbase"]
+        self.stopped = state["stopped"]
+        self.steps = state["steps"]
+        self.pending = collections.deque(state["pending"])
+        memory = Int64Memory if state.get("typed") else Memory
+        self.mem = memory.from_state(state["mem"])
+
+    def save(self, path):
+        """Save the machine's state to a file, to be restored with load()."""
+        data = zlib.compress(pickle.dumps(self.get_state()))
+        # Write a temporary file and rename it, so a crash while saving
+        # doesn't lose an earlier save.
+        temp_name = f"{path}.{os.getpid()}.tmp"
+        with open(temp_name, "wb") as f:
+            f.write(self.SAVE_HEADER.pack(self.SAVE_MAGIC, self.SAVE_VERSION))
+            f.write(data)
+        os.replace(temp_name, path)
+
+    @classmethod
+    def load(cls, path, input_fn=None, output_fn=print):
+        """Make a machine from a file written by save()."""
+        with open(path, "rb") as f:
+            data = f.read()
+        header = data[:cls.SAVE_HEADER.size]
+        if header != cls.SAVE_HEADER.pack(cls.SAVE_MAGIC, cls.SAVE_VERSION):
+            raise ValueError(f"{path} isn't a version {cls.SAVE_VERSION} saved IntCode machine")
+        cpu = object.__new__(cls)
+        IntCode.__init__(cpu, [], input_fn, output_fn)
+        cpu.set_state(pickle.loads(zlib.decompress(data[cls.SAVE_HEADER.size:])))
+        return cpu
+
+    def decode(self, ip):
+        """Decode the instruction at `ip`, and remember it."""
+        instruction = self[ip]
+        info = OPS_BY_CODE.get(instruction % 100)
+        if info is None:
+            Op(instruction % 100)   # raises ValueError
+        op, nparams, handler_name = info
+        modes = instruction // 100
+        params = []
+        for i in range(nparams):
+            mode = modes % 10
+            if mode > RELATIVE:
+                Mode(mode)          # raises ValueError
+            modes //= 10
+            params.append((mode, self[ip + 1 + i]))
+        inst = Instruction(
+            op=op,
+            modes=tuple(mode for mode, _ in params),
+            params=tuple(params),
+            handler=getattr(type(self), handler_name),
+            size=nparams + 1,
+        )
+        self.decoded[ip] = inst
+        decoded_at = self.decoded_at
+        for addr in range(ip, ip + inst.size):
+            decoded_at[addr] = decoded_at.get(addr, ()) + (ip,)
         return inst
 
-    def get_parameter_value(self):
-        mode = Mode(self.modes % 10)
-        self.modes //= 10
-        ivalue = self.next_instruction()
-        if mode == Mode.POSITION:
-            return self[ivalue]
-        elif mode == Mode.IMMEDIATE:
-            return ivalue
-        elif mode == Mode.RELATIVE:
-            return self[self.relbase + ivalue]
-
-    def set_at_parameter(self, value):
-        mode = Mode(self.modes % 10)
-        self.modes //= 10
-        ivalue = self.next_instruction()
-        if mode == Mode.POSITION:
-            addr = ivalue
-        elif mode == Mode.IMMEDIATE:
+    def invalidate(self, addr):
+        """Forget any decoded instructions (and compiled blocks) that include `addr`."""
+        for ip in self.decoded_at.pop(addr, ()):
+            starts = self.blocks_with.pop(ip, ())
+            if starts:
+                self.rewrites[ip] = self.rewrites.get(ip, 0) + 1
+                for start in starts:
+                    self.blocks.pop(start, None)
+            inst = self.decoded.pop(ip, None)
+            if inst is not None:
+                for other in range(ip, ip + inst.size):
+                    if other != addr:
+                        self.decoded_at[other] = tuple(i for i in self.decoded_at[other] if i != ip)
+
+    def read(self, param):
+        mode, addr = param
+        if mode == IMMEDIATE:
+            return addr
+        elif mode == RELATIVE:
+            addr += self.relbase
+        mem = self.mem
+        # Inline the common case of reading from the program image.
+        if 0 <= addr < mem.size:
+            return mem.image[addr]
+        return mem[addr]
+
+    def write(self, param, value):
+        mode, addr = param
+        if mode == RELATIVE:
+            addr += self.relbase
+        elif mode == IMMEDIATE:
             raise Exception("Can't set a value in immediate mode")
-        elif mode == Mode.RELATIVE:
-            addr = self.relbase + ivalue
-        self.mem[addr] = value
+        mem = self.mem
+        if 0 <= addr < mem.size and mem.image_owned:
+            try:
+                mem.image[addr] = value
+            except OverflowError:
+                # Too big for Int64Memory: this promotes it.
+                mem[addr] = value
+        else:
+            mem[addr] = value
+        if addr in self.decoded_at:
+            self.invalidate(addr)
+
+    def do_add(self, a, b, dest):
+        self.write(dest, self.read(a) + self.read(b))
+        return True
+
+    def do_mul(self, a, b, dest):
+        self.write(dest, self.read(a) * self.read(b))
+        return True
+
+    def do_input(self, dest):
+        pending = self.pending
+        self.write(dest, pending.popleft() if pending else self.input_fn())
+        return True
+
+    def do_output(self, a):
+        self.output_fn(self.read(a))
+        return True
+
+    def do_jump_if_true(self, val, where):
+        if self.read(val) != 0:
+            self.ip = self.read(where)
+        return True
+
+    def do_jump_if_false(self, val, where):
+        if self.read(val) == 0:
+            self.ip = self.read(where)
+        return True
+
+    def do_less_than(self, a, b, dest):
+        self.write(dest, int(self.read(a) < self.read(b)))
+        return True
+
+    def do_equals(self, a, b, dest):
+        self.write(dest, int(self.read(a) == self.read(b)))
+        return True
+
+    def do_adjrel(self, a):
+        self.relbase += self.read(a)
+        return True
+
+    def do_stop(self):
+        self.stopped = True
+        return False
 
     def step(self):
-        """Run the next instruction, return True if we should keep going."""
+        """Run the next instruction, return True if we should keep going.
+
+        If the instruction raises an exception (for example, because the
+        input function has nothing to give), the instruction pointer is left
+        at the instruction so it can be retried.
+        """
         self.steps += 1
-        instruction = self.next_instruction()
-        op = Op(instruction % 100)
-        self.modes = instruction // 100
-        if op == Op.ADD:
-            result = self.get_parameter_value() + self.get_parameter_value()
-            self.set_at_parameter(result)
-        elif op == Op.MUL:
-            result = self.get_parameter_value() * self.get_parameter_value()
-            self.set_at_parameter(result)
-        elif op == Op.INPUT:
-            self.set_at_parameter(self.input_fn())
-        elif op == Op.OUTPUT:
-            self.output_fn(self.get_parameter_value())
-        elif op == Op.JUMP_IF_TRUE:
-            val = self.get_parameter_value()
-            where = self.get_parameter_value()
-            if val != 0:
-                self.ip = where
-        elif op == Op.JUMP_IF_FALSE:
-            val = self.get_parameter_value()
-            where = self.get_parameter_value()
-            if val == 0:
-                self.ip = where
-        elif op == Op.EQUALS:
-            result = int(self.get_parameter_value() == self.get_parameter_value())
-            self.set_at_parameter(result)
-        elif op == Op.LESS_THAN:
-            result = int(self.get_parameter_value() < self.get_parameter_value())
-            self.set_at_parameter(result)
-        elif op == Op.ADJREL:
-            self.relbase += self.get_parameter_value()
-        elif op == Op.STOP:
-            self.stopped = True
-            return False
-        return True
+        ip = self.ip
+        inst = self.decoded.get(ip)
+        if inst is None:
+            inst = self.decode(ip)
+        self.ip = ip + inst.size
+        try:
+            return inst.handler(self, *inst.params)
+        except BaseException:
+            self.ip = ip
+            raise
+
+    def run(self, max_steps=None):
+        """Run the program, and return a Status saying why we stopped.
+
+        Runs until the program stops (HALTED), or needs input when nothing has
+        been fed and there's no input function (BLOCKED), or has run
+        `max_steps` more instructions (BUDGET).  A blocked machine is left at
+        the input instruction, so it can continue once it's fed.
+        """
+        if self.stopped:
+            return Status.HALTED
+        step = self.step
+        try:
+            if max_steps is None:
+                while step():
+                    pass
+            else:
+                for _ in range(max_steps):
+                    if not step():
+                        break
+                else:
+                    return Status.BUDGET
+        except NeedInput:
+            return Status.BLOCKED
+        return Status.HALTED
+
+    def run_gen(self):
+        """Run the program as a generator.
+
+        Each output value is yielded.  When the program needs input, the
+        generator yields None, and the value should be passed in with send().
+        Values given with feed() are used first, without yielding.  While
+        waiting for input, the machine is left at the input instruction, so it
+        can be forked.  The generator finishes when the program stops.  The
+        input and output functions aren't used.
+        """
+        decoded = self.decoded
+        while True:
+            ip = self.ip
+            inst = decoded.get(ip)
+            if inst is None:
+                inst = self.decode(ip)
+            op = inst.op
+            if op is Op.INPUT:
+                if self.pending:
+                    value = self.pending.popleft()
+                else:
+                    value = yield None
+                    if value is None:
+                        raise TypeError("run_gen() needs input values passed with send()")
+                self.steps += 1
+                self.ip = ip + 2
+                self.write(inst.params[0], value)
+            elif op is Op.OUTPUT:
+                self.steps += 1
+                self.ip = ip + 2
+                yield self.read(inst.params[0])
+            elif op is Op.STOP:
+                self.steps += 1
+                self.ip = ip + 1
+                self.stopped = True
+                return
+            else:
+                self.steps += 1
+                self.ip = ip + inst.size
+                inst.handler(self, *inst.params)
+
+    def run_compiled(self, max_steps=None):
+        """Run like run(), but compile basic blocks into Python functions first.
+
+        Each block is a straight run of instructions ending at a jump, an input
+        or output, or a stop.  Writes into decoded instructions invalidate the
+        blocks that use them, so self-modifying programs behave the same.
+
+        Returns a Status like run() does.  The `max_steps` budget is checked
+        between blocks, so it can run a little past.
+        """
+        mem = self.mem
+        blocks = self.blocks
+        limit = float("inf") if max_steps is None else self.steps + max_steps
+        try:
+            while not self.stopped:
+                if self.steps >= limit:
+                    return Status.BUDGET
+                # Output functions can fork us, so check before every block.
+                if not mem.image_owned:
+                    mem.own_image()
+                block = blocks.get(self.ip)
+                if block is None:
+                    block = self.compile_block(self.ip)
+                self.ip = block(self, mem, mem.image)
+        except NeedInput:
+            return Status.BLOCKED
+        return Status.HALTED
+
+    MAX_BLOCK = 100
+    # Instructions that keep getting overwritten are interpreted instead.
+    MAX_REWRITES = 3
+
+    def compile_block(self, start):
+        """Compile the basic block at `start` into a function, and remember it.
+
+        The function takes (cpu, mem, img), runs the block, and returns the
+        address to continue at.  It keeps the relative base in a local, and
+        updates cpu.relbase and cpu.steps whenever it leaves.
+        """
+        rewrites = self.rewrites
+        if rewrites.get(start, 0) >= self.MAX_REWRITES:
+            self.blocks[start] = interpret_one
+            return interpret_one
+
+        size = self.mem.size
+        typed = self.mem.typed
+
+        def read(param):
+            mode, value = param
+            if mode == IMMEDIATE:
+                return repr(value)
+            elif mode == POSITION:
+                if 0 <= value < size:
+                    return f"img[{value}]"
+                return f"mem[{value}]"
+            else:
+                return f"(img[t] if 0 <= (t := rb + {value}) < n else mem[t])"
+
+        def leave(count, indent="    "):
+            return [
+                f"{indent}cpu.relbase = rb",
+                f"{indent}cpu.steps += {count}",
+            ]
+
+        def write(param, expr, count, next_ip):
+            mode, value = param
+            if mode == POSITION:
+                addr = repr(value)
+                if 0 <= value < size:
+                    lines = [f"    img[{value}] = {expr}"]
+                    if typed:
+                        lines = [f"    v = {expr}"] + store(addr, "    ", count, next_ip)
+                else:
+                    lines = [f"    mem[{value}] = {expr}", "    n = len(img)"]
+                    if typed:
+                        lines[1:1] = promoted(addr, "    ", count, next_ip)
+            else:
+                addr = "a"
+                lines = [
+                    f"    v = {expr}",
+                    f"    a = rb + {value}",
+                    "    if 0 <= a < n:",
+                    "        img[a] = v",
+                    "    else:",
+                    "        mem[a] = v",
+                    "        n = len(img)",
+                ]
+                if typed:
+                    lines[6:6] = promoted(addr, "        ", count, next_ip)
+                    lines[3:4] = store(addr, "        ", count, next_ip)
+            # If we wrote over a decoded instruction, stop here.
+            lines += [f"    if {addr} in decoded_at:", f"        cpu.invalidate({addr})"]
+            if count is not None:
+                lines += leave(count, "        ")
+            lines += [f"        return {next_ip}"]
+            return lines
+
+        def store(addr, indent, count, next_ip):
+            # Storing v into Int64Memory's array can overflow.  Then store it
+            # through mem, which promotes it to lists, and leave the block,
+            # since img is no longer the image.
+            lines = [f"{indent}try:", f"{indent}    img[{addr}] = v", f"{indent}except OverflowError:"]
+            lines += [f"{indent}    mem[{addr}] = v"]
+            return lines + leave_after_write(addr, indent + "    ", count, next_ip)
+
+        def promoted(addr, indent, count, next_ip):
+            # A write through mem can promote Int64Memory too, and then img
+            # is no longer the image, so leave the block.
+            lines = [f"{indent}if mem.image is not img:"]
+            return lines + leave_after_write(addr, indent + "    ", count, next_ip)
+
+        def leave_after_write(addr, indent, count, next_ip):
+            lines = leave(count, indent) if count is not None else []
+            return lines + [
+                f"{indent}if {addr} in decoded_at:",
+                f"{indent}    cpu.invalidate({addr})",
+                f"{indent}return {next_ip}",
+            ]
+
+        code = [
+            "def block(cpu, mem, img):",
+            "    rb = cpu.relbase",
+            "    n = len(img)",
+            "    decoded_at = cpu.decoded_at",
+        ]
+        ips = []
+        ip = start
+        count = 0
+        while True:
+            if ip != start and rewrites.get(ip, 0) >= self.MAX_REWRITES:
+                code += leave(count) + [f"    return {ip}"]
+                break
+            inst = self.decoded.get(ip)
+            if inst is None:
+                try:
+                    inst = self.decode(ip)
+                except ValueError:
+                    # Not an instruction: let the interpreter raise the error.
+                    code += leave(count) + [f"    cpu.ip = {ip}", "    cpu.step()", "    return cpu.ip"]
+                    break
+            op = inst.op
+            params = inst.params
+            if op in WRITE_OPS and params[-1][0] == IMMEDIATE:
+                # Let the interpreter raise the error.
+                code += leave(count) + [f"    cpu.ip = {ip}", "    cpu.step()", "    return cpu.ip"]
+                break
+            ips.append(ip)
+            count += 1
+            next_ip = ip + inst.size
+            code.append(f"    # {ip}: {op.name} {params}")
+            if op in (Op.ADD, Op.MUL, Op.LESS_THAN, Op.EQUALS):
+                a, b = read(params[0]), read(params[1])
+                expr = {
+                    Op.ADD: f"{a} + {b}",
+                    Op.MUL: f"{a} * {b}",
+                    Op.LESS_THAN: f"(1 if {a} < {b} else 0)",
+                    Op.EQUALS: f"(1 if {a} == {b} else 0)",
+                }[op]
+                code += write(params[2], expr, count, next_ip)
+            elif op == Op.ADJREL:
+                code.append(f"    rb += {read(params[0])}")
+            elif op == Op.INPUT:
+                # Leave the machine ready to retry the instruction if the input
+                # function raises an exception.
+                code += leave(count) + [f"    cpu.ip = {ip}"]
+                value = "(cpu.pending.popleft() if cpu.pending else cpu.input_fn())"
+                code += write(params[0], value, None, next_ip)
+                code += [f"    return {next_ip}"]
+                break
+            elif op == Op.OUTPUT:
+                code += leave(count) + [f"    cpu.ip = {ip}"]
+                code += [f"    cpu.output_fn({read(params[0])})", f"    return {next_ip}"]
+                break
+            elif op in (Op.JUMP_IF_TRUE, Op.JUMP_IF_FALSE):
+                test = "!=" if op == Op.JUMP_IF_TRUE else "=="
+                code += leave(count)
+                code += [
+                    f"    if {read(params[0])} {test} 0:",
+                    f"        return {read(params[1])}",
+                    f"    return {next_ip}",
+                ]
+                break
+            elif op == Op.STOP:
+                code += leave(count) + ["    cpu.stopped = True", f"    return {next_ip}"]
+                break
+            ip = next_ip
+            if count >= self.MAX_BLOCK:
+                code += leave(count) + [f"    return {ip}"]
+                break
+
+        globs = {}
+        exec("\n".join(code) + "\n", globs)
+        block = globs["block"]
+        block.source = code
+        self.blocks[start] = block
+        for ip in ips:
+            self.blocks_with[ip] = self.blocks_with.get(ip, ()) + (start,)
+        return block
+
+
+def interpret_one(cpu, mem, img):
+    """A stand-in for a compiled block: run one instruction with the interpreter."""
+    cpu.step()
+    return cpu.ip
+
+
+class Scheduler:
+    """Run many machines round-robin, a quantum of instructions at a time.
+
+    Machines that block for input are set aside until wake() is called,
+    usually after feeding them.  Machines that halt are dropped.  Each
+    machine can have its own quantum, or use the scheduler's.
+    """
+    def __init__(self, machines=(), quantum=1000, compiled=False):
+        self.quantum = quantum
+        self.compiled = compiled
+        self.ready = collections.deque()
+        self.blocked = set()
+        self.quanta = {}
+        for cpu in machines:
+            self.add(cpu)
+
+    def add(self, cpu, quantum=None):
+        self.quanta[cpu] = quantum or self.quantum
+        self.ready.append(cpu)
+
+    def wake(self, cpu):
+        """Let a blocked machine run again."""
+        if cpu in self.blocked:
+            self.blocked.remove(cpu)
+            self.ready.append(cpu)
+
+    def run_round(self):
+        """Give each ready machine one quantum.  Returns how many are still ready to run."""
+        for _ in range(len(self.ready)):
+            cpu = self.ready.popleft()
+            if self.compiled:
+                status = cpu.run_compiled(max_steps=self.quanta[cpu])
+            else:
+                status = cpu.run(max_steps=self.quanta[cpu])
+            if status is Status.BUDGET:
+                self.ready.append(cpu)
+            elif status is Status.BLOCKED:
+                self.blocked.add(cpu)
+            else:
+                del self.quanta[cpu]
+        return len(self.ready)
 
     def run(self):
-        while self.step():
-            pass
+        """Run until every machine is blocked or halted."""
+        while self.ready:
+            self.run_round()
+
 
+def test_memory():
+    mem = Memory([1, 2, 3])
+    assert mem[1] == 2
+    assert mem[3] == mem[5000] == mem[10**9] == 0
+    assert len(mem) == 3
+    mem[5000] = 17
+    mem[10**9] = 23
+    assert mem[5000] == 17
+    assert mem[10**9] == 23
+    assert mem[4999] == mem[10**9 + 1] == 0
+    assert len(mem) == 10**9 + 1
+    assert mem.dump(range(2, 5)) == [3, 0, 0]
+    assert mem.dump([10**9, 5000, 0]) == [23, 17, 1]
 
-def final_state(first):
+def test_int64_memory():
+    mem = Int64Memory([1, 2, 3])
+    mem[5000] = 17
+    mem[10**9] = 2**63 - 1
+    assert mem.typed
+    assert isinstance(mem.image, array.array)
+    other = mem.fork()
+    other[10**9 + 1] = 2**63
+    other[4] = -2**64
+    assert not other.typed
+    assert other.dump([10**9, 10**9 + 1, 4, 5000]) == [2**63 - 1, 2**63, -2**64, 17]
+    assert mem.typed
+    assert mem.dump([10**9, 10**9 + 1, 4, 5000]) == [2**63 - 1, 0, 0, 17]
+    assert mem.dump(range(3)) == [1, 2, 3]
+    assert not Int64Memory([2**70]).typed
+
+
+def final_state(first, compiled=False):
     cpu = IntCode(first)
-    cpu.run()
-    return [cpu[addr] for addr in range(max(cpu.mem)+1)]
+    if compiled:
+        cpu.run_compiled()
+    else:
+        cpu.run()
+    return cpu.mem.dump(range(len(cpu.mem)))
 
 # The tests from day 2.
 @pytest.mark.parametrize("first, last", [
@@ -120,26 +852,51 @@ def final_state(first):
     ([2,4,4,5,99,0], [2,4,4,5,99,9801]),
     ([1,1,1,4,99,5,6,0,99], [30,1,1,4,2,5,6,0,99]),
 ])
-def test_from_day2(first, last):
-    assert final_state(first) == last
+@pytest.mark.parametrize("compiled", [False, True])
+def test_from_day2(first, last, compiled):
+    assert final_state(first, compiled) == last
 
 @pytest.mark.parametrize("first, last", [
     ([1002,4,3,4,33], [1002, 4, 3, 4, 99]),
 ])
-def test_final_state(first, last):
-    assert final_state(first) == last
+@pytest.mark.parametrize("compiled", [False, True])
+def test_final_state(first, last, compiled):
+    assert final_state(first, compiled) == last
+
 
+def out_of_input():
+    raise IndexError("No more input")
 
 class CagedIntCode(IntCode):
-    def __init__(self, mem, inputs):
-        self.inputs = list(reversed(inputs))
+    def __init__(self, mem, inputs, typed=False):
         self.outputs = []
-        super().__init__(mem, input_fn=self.inputs.pop, output_fn=self.outputs.append)
+        super().__init__(mem, input_fn=out_of_input, output_fn=self.outputs.append, typed=typed)
+        self.feed(inputs)
 
+    def fork(self):
+        other = super().fork()
+        other.outputs = list(self.outputs)
+        other.output_fn = other.outputs.append
+        return other
 
-def produces(mem, inputs=()):
-    cpu = CagedIntCode(mem, inputs)
-    cpu.run()
+    def get_state(self):
+        state = super().get_state()
+        state["outputs"] = self.outputs
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.input_fn = out_of_input
+        self.outputs = list(state["outputs"])
+        self.output_fn = self.outputs.append
+
+
+def produces(mem, inputs=(), compiled=False, typed=False):
+    cpu = CagedIntCode(mem, inputs, typed)
+    if compiled:
+        cpu.run_compiled()
+    else:
+        cpu.run()
     return cpu.outputs
 
 @pytest.mark.parametrize("mem, inputs, outputs", [
@@ -173,24 +930,328 @@ def produces(mem, inputs=()):
         1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,
         999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99], [9], [1001]),
 ])
-def test_produces(mem, inputs, outputs):
-    assert produces(mem, inputs) == outputs
+@pytest.mark.parametrize("compiled", [False, True])
+@pytest.mark.parametrize("typed", [False, True])
+def test_produces(mem, inputs, outputs, compiled, typed):
+    assert produces(mem, inputs, compiled, typed) == outputs
 
 
+def test_run_gen_uses_fed_input():
+    # Output the sum of two inputs.
+    program = [3,20, 3,21, 1,20,21,20, 4,20, 99]
+    cpu = IntCode(program)
+    cpu.feed([3])
+    gen = cpu.run_gen()
+    assert next(gen) is None
+    assert gen.send(4) == 7
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_feed_text(compiled):
+    # Echo three characters.
+    program = [3,100, 4,100, 3,100, 4,100, 3,100, 4,100, 99]
+    cpu = CagedIntCode(program, [])
+    cpu.feed_text("Hi\n")
+    if compiled:
+        cpu.run_compiled()
+    else:
+        cpu.run()
+    assert cpu.outputs == [72, 105, 10]
+
+def test_run_gen():
+    # Is the input equal to 8?  Then output the input.
+    program = [3,13, 1008,13,8,14, 4,14, 4,13, 1105,1,0, 0,0]
+    gen = IntCode(program).run_gen()
+    assert next(gen) is None
+    assert gen.send(8) == 1
+    assert next(gen) == 8
+    assert next(gen) is None
+    assert gen.send(7) == 0
+    assert next(gen) == 7
+
+
+def run_until_out_of_input(cpu):
+    with pytest.raises(IndexError):
+        cpu.run()
+
+def test_fork():
+    # Read numbers forever, outputting the running total, kept in 20.  Also
+    # write to a far address, to exercise pages.
+    program = [3,19, 1,19,20,20, 4,20, 21101,0,0,100000, 1105,1,0, 0,0,0,0, 0,0]
+    cpu = CagedIntCode(program, [1, 2])
+    run_until_out_of_input(cpu)
+    assert cpu.outputs == [1, 3]
+
+    other = cpu.fork()
+    cpu.feed([10])
+    run_until_out_of_input(cpu)
+    other.feed([100])
+    run_until_out_of_input(other)
+    assert cpu.outputs == [1, 3, 13]
+    assert other.outputs == [1, 3, 103]
+    assert cpu[20] == 13
+    assert other[20] == 103
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_run_status(compiled):
+    # Output the running total of the inputs, forever.
+    program = [3,20, 1,20,21,21, 4,21, 1105,1,0]
+    outputs = []
+    cpu = IntCode(program, output_fn=outputs.append)
+    run = cpu.run_compiled if compiled else cpu.run
+    assert run() is Status.BLOCKED
+    assert cpu.ip == 0
+    cpu.feed([1, 2])
+    assert run() is Status.BLOCKED
+    assert outputs == [1, 3]
+    cpu.feed([3])
+    assert run(max_steps=2) is Status.BUDGET
+    # Compiled blocks can go a little past the budget.
+    assert cpu.steps == 12 or (compiled and cpu.steps > 12)
+    assert run() is Status.BLOCKED
+    assert outputs == [1, 3, 6]
+    assert IntCode([1101,1,1,5, 99,0]).run(max_steps=2) is Status.HALTED
+
+def test_scheduler():
+    # Count down from the input, outputting each number, then stop.
+    program = [3,20, 4,20, 1001,20,-1,20, 1005,20,2, 99]
+    outputs = []
+    cpus = [IntCode(program, output_fn=outputs.append) for _ in range(3)]
+    scheduler = Scheduler(cpus, quantum=3)
+    scheduler.run()
+    assert scheduler.blocked == set(cpus)
+    assert outputs == []
+    cpus[0].feed([3])
+    cpus[1].feed([2])
+    scheduler.wake(cpus[0])
+    scheduler.wake(cpus[1])
+    scheduler.run()
+    # They took turns.
+    assert outputs == [3, 2, 2, 1, 1]
+    assert scheduler.blocked == {cpus[2]}
+    assert cpus[0].stopped and cpus[1].stopped
+
+def test_save_and_load(tmp_path):
+    # The same program as test_fork.
+    program = [3,19, 1,19,20,20, 4,20, 21101,0,0,100000, 1105,1,0, 0,0,0,0, 0,0]
+    cpu = CagedIntCode(program, [1, 2])
+    run_until_out_of_input(cpu)
+    cpu.feed([5])
+    path = str(tmp_path / "machine")
+    cpu.save(path)
+
+    other = CagedIntCode.load(path)
+    assert (other.ip, other.relbase, other.steps) == (cpu.ip, cpu.relbase, cpu.steps)
+    assert list(other.pending) == [5]
+    assert other.outputs == [1, 3]
+    for machine in [cpu, other]:
+        machine.feed([10])
+        run_until_out_of_input(machine)
+    assert other.outputs == cpu.outputs == [1, 3, 8, 18]
+    assert other.mem.dump(range(len(other.mem))) == cpu.mem.dump(range(len(cpu.mem)))
+
+def test_load_wrong_file(tmp_path):
+    path = tmp_path / "machine"
+    path.write_bytes(b"1,2,3,99")
+    with pytest.raises(ValueError, match="isn't a version 1 saved IntCode machine"):
+        IntCode.load(str(path))
+
+
+class AsciiSink:
+    """An output function for programs that print ASCII text.
+
+    Text is collected in a bytearray.  If `line_fn` is given, it's called
+    with each whole line, including its newline.  Otherwise the text waits
+    for take(), usually when the program asks for input, so the consumer
+    gets a whole prompt at once.  Values that aren't ASCII (scores and
+    such) are passed to `value_fn`, or kept in self.values.
+    """
+    def __init__(self, line_fn=None, value_fn=None):
+        self.text = bytearray()
+        self.values = []
+        self.line_fn = line_fn
+        self.value_fn = value_fn or self.values.append
+
+    def __call__(self, val):
+        if 0 <= val < 128:
+            self.text.append(val)
+            if val == 10 and self.line_fn is not None:
+                self.line_fn(self.take())
+        else:
+            self.value_fn(val)
+
+    def take(self):
+        """Get the text collected so far, and forget it."""
+        text = self.text.decode("ascii")
+        self.text.clear()
+        return text
+
+    def copy(self):
+        keeping_values = self.value_fn == self.values.append
+        other = AsciiSink(self.line_fn, None if keeping_values else self.value_fn)
+        other.text = bytearray(self.text)
+        other.values = list(self.values)
+        return other
+
+def test_ascii_sink():
+    lines = []
+    sink = AsciiSink(lines.append)
+    cpu = IntCode([104,72, 104,105, 104,10, 104,1000, 104,10, 104,63, 99], output_fn=sink)
+    cpu.run()
+    assert lines == ["Hi\n", "\n"]
+    assert sink.values == [1000]
+    assert sink.take() == "?"
+    assert sink.take() == ""
+
+
+# Parsed programs are cached next to their text, in a file that starts with a
+# header: magic, the SHA-256 of the text, and the format of the rest.  That's
+# "q" for an array of 64-bit ints, or "p" for a pickled list of bigger ones.
+CACHE_HEADER = struct.Struct("<8s32sc7x")
+CACHE_MAGIC = b"INTCODE1"
+
+# Programs already loaded in this process, by file name: the file's
+# (mtime, size) when loaded, and the parsed values.
+loaded_programs = {}
+
 def program_from_file(fname):
-    with open(fname) as f:
-        return [int(v) for v in f.read().split(",")]
+    """Read a comma-separated program, and return it as a list of ints.
+
+    The parsed program is cached in a .progcache file next to the text file,
+    and in this process, so the text is only parsed when it changes.  The
+    cache file is mapped read-only, so processes share its pages.
+    """
+    stat = os.stat(fname)
+    key = (stat.st_mtime_ns, stat.st_size)
+    loaded = loaded_programs.get(fname)
+    if loaded is None or loaded[0] != key:
+        with open(fname, "rb") as f:
+            text = f.read()
+        loaded = loaded_programs[fname] = (key, cached_program(fname + ".progcache", text))
+    values = loaded[1]
+    return values.tolist() if isinstance(values, memoryview) else list(values)
+
+def cached_program(cache_name, text):
+    """Get the parsed `text` from `cache_name`, or parse it and write the cache."""
+    digest = hashlib.sha256(text).digest()
+    try:
+        with open(cache_name, "rb") as f:
+            cached = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        pass
+    else:
+        if len(cached) >= CACHE_HEADER.size:
+            magic, cached_digest, kind = CACHE_HEADER.unpack_from(cached)
+            if magic == CACHE_MAGIC and cached_digest == digest:
+                if kind == b"q":
+                    # The memoryview keeps the mmap open.
+                    return memoryview(cached)[CACHE_HEADER.size:].cast("q")
+                elif kind == b"p":
+                    values = pickle.loads(cached[CACHE_HEADER.size:])
+                    cached.close()
+                    return values
+        cached.close()
+
+    values = [int(v) for v in text.split(b",")]
+    try:
+        data = array.array("q", values).tobytes()
+        kind = b"q"
+    except OverflowError:
+        data = pickle.dumps(values)
+        kind = b"p"
+    # Write a temporary file and rename it, so other processes never see a
+    # partly written cache.
+    temp_name = f"{cache_name}.{os.getpid()}.tmp"
+    try:
+        with open(temp_name, "wb") as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, digest, kind))
+            f.write(data)
+        os.replace(temp_name, cache_name)
+    except OSError:
+        # Can't write the cache?  We still have the values.
+        pass
+    return values
+
+@pytest.mark.parametrize("text, values", [
+    ("1,0,0,3,99\n", [1, 0, 0, 3, 99]),
+    ("104,1125899906842624,99", [104, 1125899906842624, 99]),
+    ("104,12345678901234567890,-3,99", [104, 12345678901234567890, -3, 99]),
+])
+def test_program_from_file(tmp_path, text, values):
+    fname = str(tmp_path / "prog.txt")
+    with open(fname, "w") as f:
+        f.write(text)
+    assert program_from_file(fname) == values
+    assert os.path.exists(fname + ".progcache")
+    # Read from the cache file, not the text.
+    del loaded_programs[fname]
+    assert program_from_file(fname) == values
+    # The copy we get is ours to change.
+    program_from_file(fname)[0] = 17
+    assert program_from_file(fname) == values
+    # A changed program isn't read from the cache.
+    with open(fname, "w") as f:
+        f.write("3,0,99")
+    assert program_from_file(fname) == [3, 0, 99]
 
 
 # Day 9 tests
-def test_day9_1():
+@pytest.mark.parametrize("compiled", [False, True])
+def test_day9_1(compiled):
     program = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
-    assert produces(program) == program
+    assert produces(program, compiled=compiled) == program
 
-def test_day9_2():
+@pytest.mark.parametrize("compiled", [False, True])
+def test_day9_2(compiled):
     program = [1102,34915192,34915192,7,4,7,99,0]
-    assert produces(program) == [34915192*34915192]
+    assert produces(program, compiled=compiled) == [34915192*34915192]
 
-def test_day9_3():
+@pytest.mark.parametrize("compiled", [False, True])
+def test_day9_3(compiled):
     program = [104,1125899906842624,99]
-    assert produces(program) == [1125899906842624]
+    assert produces(program, compiled=compiled) == [1125899906842624]
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_typed_overflow(compiled):
+    # Square 2**40 into position 20, then square that into relative 21.
+    program = [1102,2**40,2**40,20, 4,20, 109,1, 22202,19,19,20, 204,20, 99, 0,0,0,0,0, 0,0]
+    cpu = CagedIntCode(program, [], typed=True)
+    if compiled:
+        cpu.run_compiled()
+    else:
+        cpu.run()
+    assert cpu.outputs == [2**80, 2**160]
+    assert not cpu.mem.typed
+
+    # The first overflow in a relative write, a far write, or an input.
+    program = [109,1, 22202,8,8,8, 204,8, 99, 2**40]
+    assert produces(program, compiled=compiled, typed=True) == [2**80]
+    program = [1102,2**40,2**40,100000, 4,100000, 99]
+    assert produces(program, compiled=compiled, typed=True) == [2**80]
+    program = [3,5, 4,5, 99, 0]
+    assert produces(program, [2**64], compiled=compiled, typed=True) == [2**64]
+
+    # After a far write promotes memory, the rest of the block must use the
+    # new image.
+    program = [1102,2**40,2**40,100000, 1101,7,0,20, 1105,1,11, 4,20, 99] + [0] * 10
+    assert produces(program, compiled=compiled, typed=True) == [7]
+    program = [109,100000, 21102,2**40,2**40,0, 1101,7,0,20, 1105,1,13, 4,20, 99] + [0] * 10
+    assert produces(program, compiled=compiled, typed=True) == [7]
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_self_modifying_code(compiled):
+    # The first instruction outputs 5, then the program changes it to output 6
+    # and loops back to run it again.
+    program = [104,5, 1101,0,6,1, 1001,20,1,20, 1008,20,2,21, 1006,21,0, 99, 0,0, 0,0]
+    assert produces(program, compiled=compiled) == [5, 6]
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_writes_next_instruction(compiled):
+    # The EQUALS changes the condition of the jump after it, so the jump
+    # goes to 10 to output 1, instead of falling through to output 0.
+    program = [1108,1,1,5, 1105,0,10, 104,0,99, 104,1,99]
+    cpu = CagedIntCode(program, [])
+    if compiled:
+        cpu.run_compiled()
+    else:
+        cpu.run()
+    assert cpu.outputs == [1]
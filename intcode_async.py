@@ -0,0 +1,80 @@
+# IntCode machines that talk through asyncio queues.
+
+import asyncio
+
+import pytest
+
+from intcode import IntCode
+
+
+class AsyncIntCode(IntCode):
+    """An IntCode machine whose input and output are asyncio queues.
+
+    run_async() runs instructions without awaiting anything until the program
+    needs input, so many machines can share an event loop without being
+    single-stepped.  Subclasses can override get_input() and put_output() to
+    do something other than use the queues.
+    """
+    def __init__(self, mem, inputs=None, outputs=None):
+        super().__init__(mem)
+        self.inputs = asyncio.Queue() if inputs is None else inputs
+        self.outputs = asyncio.Queue() if outputs is None else outputs
+
+    def set_state(self, state):
+        super().set_state(state)
+        # The queues aren't saved: they're usually shared with other
+        # machines.  A loaded machine wasn't made by __init__, so it gets
+        # queues of its own.
+        if not hasattr(self, "inputs"):
+            self.inputs = asyncio.Queue()
+            self.outputs = asyncio.Queue()
+
+    async def get_input(self):
+        return await self.inputs.get()
+
+    async def put_output(self, value):
+        await self.outputs.put(value)
+
+    async def run_async(self):
+        gen = self.run_gen()
+        try:
+            value = next(gen)
+            while True:
+                if value is None:
+                    value = gen.send(await self.get_input())
+                else:
+                    await self.put_output(value)
+                    value = next(gen)
+        except StopIteration:
+            pass
+
+
+async def run_looped_amplifiers(mem, phase_settings):
+    queues = [asyncio.Queue() for _ in phase_settings]
+    for queue, setting in zip(queues, phase_settings):
+        queue.put_nowait(setting)
+    queues[0].put_nowait(0)
+    amps = [
+        AsyncIntCode(mem, inputs, outputs)
+        for inputs, outputs in zip(queues, queues[1:] + queues[:1])
+    ]
+    await asyncio.gather(*(amp.run_async() for amp in amps))
+    return queues[0].get_nowait()
+
+# The looped examples from day 7.
+@pytest.mark.parametrize("mem, settings, output", [
+    ([3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5], (9,8,7,6,5), 139629729),
+    ([3,52,1001,52,-5,52,3,53,1,52,56,54,1007,54,5,55,1005,55,26,1001,54,-5,54,1105,1,12,1,53,54,53,1008,54,0,55,1001,55,1,55,2,53,55,53,4,53,1001,56,-1,56,1005,56,6,99,0,0,0,0,10], (9,7,8,5,6), 18216),
+])
+def test_looped_amplifiers(mem, settings, output):
+    assert asyncio.run(run_looped_amplifiers(mem, settings)) == output
+
+def test_save_and_load(tmp_path):
+    # Output the sum of two inputs.
+    path = str(tmp_path / "machine")
+    AsyncIntCode([3,20, 3,21, 1,20,21,20, 4,20, 99]).save(path)
+    cpu = AsyncIntCode.load(path)
+    for value in [3, 4]:
+        cpu.inputs.put_nowait(value)
+    asyncio.run(cpu.run_async())
+    assert cpu.outputs.get_nowait() == 7
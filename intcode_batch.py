@@ -0,0 +1,216 @@
+# Run many copies of one IntCode program in lockstep, with NumPy.
+
+import numpy as np
+import pytest
+
+from intcode import IMMEDIATE, OPS, POSITION, RELATIVE, CagedIntCode, Op, produces
+
+
+class BatchIntCode:
+    """Many machines running the same program, each with its own inputs.
+
+    All the machine state is in NumPy arrays, one row (or "lane") per machine.
+    Each step runs one instruction on every running lane.  Lanes that are at
+    the same instruction are run together, so lanes that have taken different
+    paths through the program still share the work with others at the same
+    place.
+
+    Values are int64, and memory is `mem_size` words per lane.  A lane whose
+    ADD or MUL would overflow, or that uses an address outside its memory, is
+    finished by the scalar interpreter instead, which has neither limit.
+    """
+    EXTRA_MEMORY = 1000
+
+    def __init__(self, program, inputs, mem_size=None):
+        nlanes = len(inputs)
+        if mem_size is None:
+            mem_size = len(program) + self.EXTRA_MEMORY
+        self.mem = np.zeros((nlanes, mem_size), dtype=np.int64)
+        self.mem[:, :len(program)] = program
+        self.ip = np.zeros(nlanes, dtype=np.int64)
+        self.relbase = np.zeros(nlanes, dtype=np.int64)
+        self.running = np.ones(nlanes, dtype=bool)
+        max_inputs = max((len(ins) for ins in inputs), default=0)
+        self.inputs = np.zeros((nlanes, max_inputs), dtype=np.int64)
+        self.num_inputs = np.zeros(nlanes, dtype=np.int64)
+        for lane, ins in enumerate(inputs):
+            self.inputs[lane, :len(ins)] = ins
+            self.num_inputs[lane] = len(ins)
+        self.next_input = np.zeros(nlanes, dtype=np.int64)
+        self.outputs = [[] for _ in range(nlanes)]
+        # Lockstep steps, and instructions run in all the lanes.
+        self.steps = 0
+        self.lane_steps = 0
+
+    def keep_inside(self, lanes, addrs, *arrays):
+        """Finish the lanes using any of `addrs` outside memory in the interpreter.
+
+        `addrs` is a list of arrays of addresses, one per lane.  Returns
+        `arrays` (also one per lane) without the finished lanes.
+        """
+        if not addrs:
+            return arrays
+        size = self.mem.shape[1]
+        outside = None
+        for where in addrs:
+            # As unsigned, negative addresses are too big.
+            out = where.view(np.uint64) >= size
+            outside = out if outside is None else outside | out
+        if not outside.any():
+            return arrays
+        self.finish_in_interpreter(lanes[outside])
+        keep = ~outside
+        return tuple(array[keep] for array in arrays)
+
+    def address(self, lanes, ip, mode, offset):
+        """Where the parameter at `offset` from `ip` lives, for each lane."""
+        if mode == IMMEDIATE:
+            return ip + offset
+        addrs = self.mem[lanes, ip + offset]
+        if mode == RELATIVE:
+            addrs = addrs + self.relbase[lanes]
+        elif mode != POSITION:
+            raise ValueError(f"{mode} is not a valid Mode")
+        return addrs
+
+    def run_group(self, instruction, lanes):
+        """Run `instruction` on all of `lanes`."""
+        op = Op(instruction % 100)
+        nparams = OPS[op][0]
+        modes = [(instruction // 10**(i+2)) % 10 for i in range(3)]
+        ip = self.ip[lanes]
+        mem = self.mem
+
+        # The addresses the parameters use have to be in memory.  step()
+        # checked the immediate ones, and a jump's target is only used by the
+        # lanes that jump.
+        used = 1 if op in (Op.JUMP_IF_TRUE, Op.JUMP_IF_FALSE) else nparams
+        addrs = [self.address(lanes, ip, modes[n], n + 1) for n in range(used)]
+        far = [where for where, mode in zip(addrs, modes) if mode != IMMEDIATE]
+        lanes, ip, *addrs = self.keep_inside(lanes, far, lanes, ip, *addrs)
+
+        def read(n):
+            return mem[lanes, addrs[n-1]]
+
+        def write(n, values):
+            if modes[n-1] == IMMEDIATE:
+                raise Exception("Can't set a value in immediate mode")
+            mem[lanes, addrs[n-1]] = values
+
+        if op in (Op.ADD, Op.MUL):
+            a, b = read(1), read(2)
+            big = self.overflows(op, a, b)
+            if big.any():
+                self.finish_in_interpreter(lanes[big])
+                keep = ~big
+                lanes, ip, a, b = lanes[keep], ip[keep], a[keep], b[keep]
+                addrs = [where[keep] for where in addrs]
+            write(3, a + b if op == Op.ADD else a * b)
+            self.ip[lanes] = ip + 4
+        elif op == Op.LESS_THAN:
+            write(3, read(1) < read(2))
+            self.ip[lanes] = ip + 4
+        elif op == Op.EQUALS:
+            write(3, read(1) == read(2))
+            self.ip[lanes] = ip + 4
+        elif op == Op.INPUT:
+            which = self.next_input[lanes]
+            if (which >= self.num_inputs[lanes]).any():
+                raise IndexError("A lane ran out of input")
+            write(1, self.inputs[lanes, which])
+            self.next_input[lanes] = which + 1
+            self.ip[lanes] = ip + 2
+        elif op == Op.OUTPUT:
+            for lane, value in zip(lanes.tolist(), read(1).tolist()):
+                self.outputs[lane].append(value)
+            self.ip[lanes] = ip + 2
+        elif op in (Op.JUMP_IF_TRUE, Op.JUMP_IF_FALSE):
+            jump = read(1) != 0
+            if op == Op.JUMP_IF_FALSE:
+                jump = ~jump
+            self.ip[lanes[~jump]] = ip[~jump] + 3
+            lanes, ip = lanes[jump], ip[jump]
+            target = self.address(lanes, ip, modes[1], 2)
+            if modes[1] != IMMEDIATE:
+                lanes, target = self.keep_inside(lanes, [target], lanes, target)
+            self.ip[lanes] = mem[lanes, target]
+        elif op == Op.ADJREL:
+            self.relbase[lanes] += read(1)
+            self.ip[lanes] = ip + 2
+        elif op == Op.STOP:
+            self.running[lanes] = False
+            self.ip[lanes] = ip + 1
+
+    @staticmethod
+    def overflows(op, a, b):
+        """Which lanes' a + b or a * b won't fit in int64."""
+        # Floats are close enough to find the candidates, then check those
+        # exactly with Python ints.
+        af, bf = a.astype(np.float64), b.astype(np.float64)
+        big = np.abs(af + bf if op == Op.ADD else af * bf) >= 2.0**62
+        for i in np.flatnonzero(big).tolist():
+            x, y = int(a[i]), int(b[i])
+            big[i] = not -2**63 <= (x + y if op == Op.ADD else x * y) < 2**63
+        return big
+
+    def finish_in_interpreter(self, lanes):
+        """Run `lanes` to the end with the scalar interpreter."""
+        for lane in lanes.tolist():
+            inputs = self.inputs[lane, self.next_input[lane]:self.num_inputs[lane]]
+            cpu = CagedIntCode(self.mem[lane].tolist(), inputs.tolist())
+            cpu.ip = int(self.ip[lane])
+            cpu.relbase = int(self.relbase[lane])
+            cpu.outputs[:0] = self.outputs[lane]
+            cpu.run()
+            self.outputs[lane] = cpu.outputs
+            self.running[lane] = False
+            self.lane_steps += cpu.steps
+
+    def step(self):
+        """Run one instruction on every running lane.  Returns True if any are still running."""
+        lanes = np.flatnonzero(self.running)
+        if not len(lanes):
+            return False
+        # The longest instruction has to fit in memory: a jump can leave a
+        # lane anywhere.
+        ip = self.ip[lanes]
+        lanes, = self.keep_inside(lanes, [ip, ip + 3], lanes)
+        if not len(lanes):
+            return True
+        self.steps += 1
+        self.lane_steps += len(lanes)
+        instructions = self.mem[lanes, self.ip[lanes]]
+        for instruction in np.unique(instructions).tolist():
+            self.run_group(instruction, lanes[instructions == instruction])
+        return True
+
+    def run(self):
+        while self.step():
+            pass
+
+
+def batch_produces(mem, input_sets):
+    batch = BatchIntCode(mem, input_sets)
+    batch.run()
+    return batch.outputs
+
+# Programs from day 5 and day 9: they should produce the same as the interpreter.
+@pytest.mark.parametrize("mem, input_sets", [
+    ([3,9,8,9,10,9,4,9,99,-1,8], [[8], [7], [77]]),
+    ([3,3,1107,-1,8,3,4,3,99], [[7], [9]]),
+    ([3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9], [[0], [17]]),
+    ([3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,
+        1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,
+        999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99], [[7], [8], [9], [-3], [100]]),
+    ([109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99], [[], []]),
+    ([1102,34915192,34915192,7,4,7,99,0], [[]]),
+    # Too big for int64 in some lanes, not others.
+    ([3,13, 1002,13,2**40,13, 1002,13,2**40,13, 4,13, 99, 0], [[1], [2**30], [-2**40], [3]]),
+    ([3,9, 1001,9,2**62,9, 4,9, 99, 0], [[2**62], [-1], [2**62 - 1]]),
+    # Past the end of memory in one lane, and a jump target that's only
+    # out of range when it isn't taken.
+    ([3,100, 1005,100,7, 99, 99, 109,5000, 21101,1,2,0, 204,0, 99], [[0], [1]]),
+    ([3,100, 1006,100,9, 6,100,5000, 99, 104,5, 99], [[0], [1]]),
+])
+def test_batch_produces(mem, input_sets):
+    assert batch_produces(mem, input_sets) == [produces(mem, inputs) for inputs in input_sets]
@@ -0,0 +1,212 @@
+# Benchmark the IntCode engines on the puzzle inputs.
+#
+#   python intcode_bench.py [--json results.json] [--compare old.json] [workload ...]
+#
+# Each workload is run with each engine it supports.  Reported: instructions
+# run, wall time, instructions per second, and the peak memory allocated
+# (from a second run, under tracemalloc, which is slow).
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from intcode import CagedIntCode, IntCode, program_from_file
+from intcode_batch import BatchIntCode
+
+ENGINES = ("interp", "compiled")
+
+def run_machine(cpu, engine):
+    if engine == "compiled":
+        cpu.run_compiled()
+    else:
+        cpu.run()
+
+# Workload functions by name, and the engines they can use.  Each function
+# takes the engine name, and returns the number of instructions run, or None
+# if it can't tell.
+WORKLOADS = {}
+
+def workload(name, *engines):
+    def _decorator(func):
+        WORKLOADS[name] = (func, engines)
+        return func
+    return _decorator
+
+@workload("day05", *ENGINES)
+def diagnostics(engine):
+    # Too quick to time once, so run both parts a hundred times.
+    program = program_from_file("day05_input.txt")
+    steps = 0
+    for _ in range(100):
+        for system_id in [1, 5]:
+            cpu = CagedIntCode(program, [system_id])
+            run_machine(cpu, engine)
+            steps += cpu.steps
+    return steps
+
+@workload("day07", "gen")
+def looped_amplifiers(engine):
+    program = program_from_file("day07_input.txt")
+    steps = 0
+    for settings in itertools.permutations(range(5, 10)):
+        amps = [IntCode(program) for _ in settings]
+        for amp, setting in zip(amps, settings):
+            amp.feed([setting])
+        gens = [amp.run_gen() for amp in amps]
+        signal = 0
+        running = True
+        while running:
+            for amp, gen in zip(amps, gens):
+                amp.feed([signal])
+                try:
+                    signal = next(gen)
+                except StopIteration:
+                    running = False
+        steps += sum(amp.steps for amp in amps)
+    return steps
+
+@workload("day09", *ENGINES)
+def boost(engine):
+    cpu = CagedIntCode(program_from_file("day09_input.txt"), [2])
+    run_machine(cpu, engine)
+    return cpu.steps
+
+@workload("day11", *ENGINES)
+def painting(engine):
+    import day11
+    robot = day11.Robot(program_from_file("day11_input.txt"), day11.Hull())
+    run_machine(robot.intcode, engine)
+    return robot.intcode.steps
+
+@workload("day13", *ENGINES)
+def arcade(engine):
+    import day13
+    game = day13.HeadlessCabinet(2)
+    run_machine(game.cpu, engine)
+    return game.cpu.steps
+
+@workload("day19", "interp", "batch")
+def beam_scan(engine):
+    program = program_from_file("day19_input.txt")
+    points = [(x, y) for y in range(50) for x in range(50)]
+    if engine == "batch":
+        batch = BatchIntCode(program, points)
+        batch.run()
+        return batch.lane_steps
+    steps = 0
+    for x, y in points:
+        cpu = CagedIntCode(program, [x, y])
+        cpu.run()
+        steps += cpu.steps
+    return steps
+
+@workload("day23", "async")
+def network(engine):
+    import day23
+    with contextlib.redirect_stdout(io.StringIO()):
+        net = day23.AsyncNetwork()
+        asyncio.run(net.run())
+    return sum(nic.steps for nic in net.nics)
+
+@workload("day25", "compiled")
+def room_mapping(engine):
+    # The machines fork so often that their steps can't be added up.
+    import day25
+    day25.map_rooms()
+    return None
+
+def measure(name, engine, memory=True, repeat=1):
+    func, _ = WORKLOADS[name]
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        steps = func(engine)
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    result = {
+        "workload": name,
+        "engine": engine,
+        "steps": steps,
+        "seconds": seconds,
+        "steps_per_sec": steps / seconds if steps else None,
+        "peak_bytes": None,
+    }
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func(engine)
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+def report(results, previous=None):
+    """Print a table of results, compared to `previous` results if given."""
+    before = {}
+    if previous:
+        before = {(r["workload"], r["engine"]): r["seconds"] for r in previous["results"]}
+    print(f"{'workload':10} {'engine':9} {'steps':>10} {'seconds':>9} {'steps/sec':>11} {'peak KB':>9}", end="")
+    print(f" {'vs before':>10}" if previous else "")
+    for r in results:
+        steps = f"{r['steps']:10d}" if r["steps"] else f"{'-':>10}"
+        rate = f"{r['steps_per_sec']:11.0f}" if r["steps_per_sec"] else f"{'-':>11}"
+        peak = f"{r['peak_bytes'] / 1024:9.0f}" if r["peak_bytes"] is not None else f"{'-':>9}"
+        print(f"{r['workload']:10} {r['engine']:9} {steps} {r['seconds']:9.3f} {rate} {peak}", end="")
+        old = before.get((r["workload"], r["engine"]))
+        if old:
+            print(f" {r['seconds'] / old:9.2f}x")
+        else:
+            print("")
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the IntCode engines.")
+    parser.add_argument("workloads", nargs="*", help=f"Workloads to run (default: all of {', '.join(WORKLOADS)})")
+    parser.add_argument("--engine", action="append", help="Only run these engines")
+    parser.add_argument("--repeat", type=int, default=1, help="Time each this many times, and keep the best")
+    parser.add_argument("--no-memory", action="store_true", help="Don't measure peak memory")
+    parser.add_argument("--json", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare to results saved in this JSON file")
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"Unknown workload: {name}")
+
+    results = []
+    for name in args.workloads or WORKLOADS:
+        for engine in WORKLOADS[name][1]:
+            if args.engine and engine not in args.engine:
+                continue
+            results.append(measure(name, engine, memory=not args.no_memory, repeat=args.repeat))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report(results, previous)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "python": sys.version,
+                "platform": platform.platform(),
+                "when": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": results,
+            }, f, indent=1)
+
+
+def test_engines_agree():
+    steps = {engine: measure("day11", engine, memory=False)["steps"] for engine in ENGINES}
+    assert len(set(steps.values())) == 1
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,327 @@
+# Memoize the subroutines of IntCode programs.
+
+import collections
+import sys
+
+import pytest
+
+from intcode import IMMEDIATE, POSITION, RELATIVE, CagedIntCode, IntCode, Op, produces, program_from_file
+
+JUMP_OPS = {Op.JUMP_IF_TRUE, Op.JUMP_IF_FALSE}
+STOP_RECORDING_OPS = {Op.INPUT, Op.OUTPUT, Op.STOP}
+
+# How a call got to a memory address: relative to the relative base when it
+# was called, or absolute.
+REL = "rel"
+ABS = "abs"
+
+# A finished call: the memory it wrote, as (kind, where, value) triples,
+# the number of steps it took, and where it returned to.
+MemoEntry = collections.namedtuple("MemoEntry", "writes, steps, next_ip")
+
+
+class Recording:
+    """What a call in progress has read and written.
+
+    `inputs` are the addresses read before the call wrote them, and `writes`
+    are the last values written, both mapping addresses to (kind, value).
+    An address used both relative and absolute can't be replayed at another
+    relative base, so read() and write() return False if that happens.
+    """
+    def __init__(self, entry, relbase, steps):
+        self.entry = entry
+        self.relbase = relbase
+        self.steps = steps
+        self.inputs = {}
+        self.writes = {}
+        self.returning = False
+
+    def kind_at(self, addr):
+        seen = self.writes.get(addr) or self.inputs.get(addr)
+        return seen and seen[0]
+
+    def read(self, kind, addr, value):
+        seen = self.kind_at(addr)
+        if seen is None:
+            self.inputs[addr] = (kind, value)
+        return seen in (None, kind)
+
+    def write(self, kind, addr, value):
+        seen = self.kind_at(addr)
+        self.writes[addr] = (kind, value)
+        return seen in (None, kind)
+
+    def where(self, kind, addr):
+        return addr - self.relbase if kind is REL else addr
+
+
+class MemoIntCode(IntCode):
+    """An IntCode machine that remembers what subroutine calls did.
+
+    A call is a jump to an ADJREL with a positive amount, the usual
+    prologue.  It returns when an ADJREL brings the relative base back to
+    what it was at the call, and a jump follows.  While a call runs, the
+    memory it reads and writes is recorded.  Calls that do I/O, or use an
+    address both relative and absolute, aren't remembered.
+
+    When the same code is called and the memory it read first has the same
+    values, the call's writes are replayed instead of running it again, and
+    it continues at the same return address.  self.steps counts the
+    replayed steps, so it's the same as without memoizing.
+
+    Only run() memoizes, not run_gen() or run_compiled().
+    """
+    # Calls nested deeper than this aren't recorded.
+    MAX_DEPTH = 1000
+    # The most call summaries to remember, and the most memory layouts for
+    # one subroutine.
+    CACHE_SIZE = 100_000
+    MAX_LAYOUTS = 10
+
+    def __init__(self, mem, input_fn=None, output_fn=print):
+        super().__init__(mem, input_fn, output_fn)
+        self.start_memo()
+
+    def start_memo(self):
+        """Start with nothing remembered."""
+        # (entry ip, layout, values) -> MemoEntry.  A layout is a tuple of
+        # (kind, where) pairs, the addresses the call read first.
+        self.cache = collections.OrderedDict()
+        self.layouts = {}
+        self.recordings = []
+        self.jumped = False
+        self.hits = 0
+        self.misses = 0
+        self.interpreted = 0
+
+    def set_state(self, state):
+        # What calls did isn't saved: a loaded machine learns it again.
+        super().set_state(state)
+        self.start_memo()
+
+    def forget_recordings(self):
+        self.recordings.clear()
+
+    def read(self, param):
+        value = IntCode.read(self, param)
+        if self.recordings:
+            mode, addr = param
+            if mode != IMMEDIATE:
+                if mode == RELATIVE:
+                    ok = self.recordings[-1].read(REL, addr + self.relbase, value)
+                else:
+                    ok = self.recordings[-1].read(ABS, addr, value)
+                if not ok:
+                    self.forget_recordings()
+        return value
+
+    def write(self, param, value):
+        IntCode.write(self, param, value)
+        if self.recordings:
+            mode, addr = param
+            if mode == RELATIVE:
+                ok = self.recordings[-1].write(REL, addr + self.relbase, value)
+            else:
+                ok = self.recordings[-1].write(ABS, addr, value)
+            if not ok:
+                self.forget_recordings()
+
+    def invalidate(self, addr):
+        # The code changed, so what we know about it is wrong.
+        super().invalidate(addr)
+        self.cache.clear()
+        self.layouts.clear()
+        self.forget_recordings()
+
+    def step(self):
+        ip = self.ip
+        inst = self.decoded.get(ip) or self.decode(ip)
+        op = inst.op
+        if self.jumped and op is Op.ADJREL and inst.modes[0] == IMMEDIATE and inst.params[0][1] > 0:
+            # A call.
+            if self.replay(ip):
+                return True
+            if len(self.recordings) < self.MAX_DEPTH:
+                self.recordings.append(Recording(ip, self.relbase, self.steps))
+            else:
+                self.forget_recordings()
+        try:
+            keep_going = IntCode.step(self)
+        except BaseException:
+            self.forget_recordings()
+            raise
+        self.interpreted += 1
+        self.jumped = op in JUMP_OPS and self.ip != ip + inst.size
+        if self.recordings:
+            recording = self.recordings[-1]
+            if recording.returning:
+                if self.jumped:
+                    self.finish_call()
+                else:
+                    self.forget_recordings()
+            elif op is Op.ADJREL:
+                if self.relbase == recording.relbase:
+                    recording.returning = True
+                elif self.relbase < recording.relbase:
+                    self.forget_recordings()
+            elif op in STOP_RECORDING_OPS:
+                self.forget_recordings()
+        return keep_going
+
+    def finish_call(self):
+        """The innermost call returned: remember what it did."""
+        recording = self.recordings.pop()
+        where = recording.where
+        inputs = [(kind, where(kind, addr), value) for addr, (kind, value) in recording.inputs.items()]
+        layout = tuple((kind, wh) for kind, wh, _ in inputs)
+        values = tuple(value for _, _, value in inputs)
+        writes = tuple((kind, where(kind, addr), value) for addr, (kind, value) in recording.writes.items())
+
+        layouts = self.layouts.setdefault(recording.entry, [])
+        if layout not in layouts:
+            if len(layouts) >= self.MAX_LAYOUTS:
+                return self.pass_up(recording.inputs.items(), recording.writes.items())
+            layouts.append(layout)
+        self.cache[recording.entry, layout, values] = MemoEntry(writes, self.steps - recording.steps, self.ip)
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        self.pass_up(recording.inputs.items(), recording.writes.items())
+
+    def pass_up(self, inputs, writes):
+        """Record a finished call's reads and writes in the call that made it."""
+        if self.recordings:
+            caller = self.recordings[-1]
+            ok = all(caller.read(kind, addr, value) for addr, (kind, value) in inputs)
+            ok = ok and all(caller.write(kind, addr, value) for addr, (kind, value) in writes)
+            if not ok:
+                self.forget_recordings()
+
+    def replay(self, entry_ip):
+        """If we know what the call at `entry_ip` will do, do it and return True."""
+        rb = self.relbase
+        mem = self.mem
+        for layout in self.layouts.get(entry_ip, ()):
+            values = tuple(mem[rb + wh if kind is REL else wh] for kind, wh in layout)
+            key = (entry_ip, layout, values)
+            entry = self.cache.get(key)
+            if entry is not None:
+                break
+        else:
+            self.misses += 1
+            return False
+
+        # The call used each address one way, relative or absolute.  At this
+        # relative base they might be the same address, and then replaying
+        # the writes in order wouldn't do what running it would.
+        used = layout + tuple((kind, wh) for kind, wh, _ in entry.writes)
+        absolute = {wh for kind, wh in used if kind is ABS}
+        if any(rb + wh in absolute for kind, wh in used if kind is REL):
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        self.cache.move_to_end(key)
+        for kind, wh, value in entry.writes:
+            IntCode.write(self, (POSITION, rb + wh if kind is REL else wh), value)
+        self.pass_up(
+            [(rb + wh if kind is REL else wh, (kind, value)) for (kind, wh), value in zip(layout, values)],
+            [(rb + wh if kind is REL else wh, (kind, value)) for kind, wh, value in entry.writes],
+        )
+        self.steps += entry.steps
+        self.ip = entry.next_ip
+        self.jumped = True
+        return True
+
+
+def run_memo(mem, inputs=()):
+    outputs = []
+    cpu = MemoIntCode(mem, output_fn=outputs.append)
+    cpu.feed(inputs)
+    cpu.run()
+    return cpu, outputs
+
+def memo_produces(mem, inputs=()):
+    """Like intcode.produces, but memoizing calls."""
+    return run_memo(mem, inputs)[1]
+
+# Read n, output fib(n), computed recursively.  fib is at 14, and is called
+# with the return address at [rb+0] and n at [rb+1], where it leaves fib(n).
+FIB = [
+    109,1000, 203,1, 21101,0,11,0, 1105,1,14, 204,1, 99,
+    # fib: if n < 2, return n.
+    109,3, 21207,-2,2,-1, 1205,-1,58,
+    # fib(n - 1), saved in a local.
+    21201,-2,-1,1, 21101,0,34,0, 1105,1,14, 21201,1,0,-1,
+    # fib(n - 2), added to it.
+    21201,-2,-2,1, 21101,0,49,0, 1105,1,14, 22201,-1,1,-2,
+    109,-3, 2105,1,0,
+    109,-3, 2105,1,0,
+]
+
+@pytest.mark.parametrize("n, fib_n", [(0, 0), (1, 1), (2, 1), (10, 55), (20, 6765)])
+def test_memo_fib(n, fib_n):
+    plain = CagedIntCode(FIB, [n])
+    plain.run()
+    assert plain.outputs == [fib_n]
+    cpu, outputs = run_memo(FIB, [n])
+    assert outputs == [fib_n]
+    assert cpu.steps == plain.steps
+    if n >= 10:
+        assert cpu.hits > 0
+        assert cpu.interpreted < plain.steps / 5
+
+def test_memo_exponential_becomes_linear():
+    # fib(60) would take about 10**13 steps without memoizing.
+    cpu, outputs = run_memo(FIB, [60])
+    assert outputs == [1548008755920]
+    assert cpu.interpreted < 5000
+
+def test_memo_save_and_load(tmp_path):
+    path = str(tmp_path / "machine")
+    cpu = MemoIntCode(FIB)
+    cpu.save(path)
+    outputs = []
+    other = MemoIntCode.load(path, output_fn=outputs.append)
+    other.feed([20])
+    other.run()
+    assert outputs == [6765]
+    assert other.hits > 0
+
+def test_memo_relative_meets_absolute():
+    # The subroutine at 40 writes 5 to [rb+1], then copies [2000] there.
+    # Called at rb=100 it returns 7.  Called again from the same place at
+    # rb=1999, [rb+1] is [2000], so it returns 5: the first call reads the
+    # same values, but can't be replayed.
+    program = [
+        109,100, 21101,0,9,0, 1105,1,40, 204,1,
+        # Twice: [30] counts the calls, and the second is at rb=1999.
+        1001,30,1,30, 1007,30,2,31, 1006,31,27, 109,1899, 1105,1,2, 99,
+    ]
+    program += [0] * (40 - len(program))
+    program += [109,2, 21101,0,5,-1, 21001,2000,0,-1, 109,-2, 2105,1,0]
+    program += [0] * (2000 - len(program)) + [7]
+    assert produces(program) == [7, 5]
+    cpu, outputs = run_memo(program)
+    assert outputs == [7, 5]
+    assert cpu.hits == 0
+
+def test_memo_code_changes():
+    cpu, outputs = run_memo(FIB, [10])
+    assert cpu.cache
+    # Make the base case n < 3, and run it again: nothing remembered is used.
+    cpu.write((POSITION, 18), 3)
+    assert not cpu.cache
+    cpu.ip = 0
+    cpu.relbase = 0
+    cpu.stopped = False
+    cpu.feed([10])
+    cpu.run()
+    changed = FIB[:18] + [3] + FIB[19:]
+    assert outputs == [55, produces(changed, [10])[0]]
+
+
+if __name__ == "__main__":
+    # python intcode_memo.py program.txt [input ...]
+    cpu, outputs = run_memo(program_from_file(sys.argv[1]), [int(v) for v in sys.argv[2:]])
+    print(outputs)
+    print(f"{cpu.steps} steps, {cpu.interpreted} interpreted, {cpu.hits} calls replayed, {cpu.misses} run")
@@ -0,0 +1,134 @@
+# Find out where an IntCode program spends its time.
+
+import collections
+import json
+import sys
+import time
+
+from intcode import CagedIntCode, IntCode, Op, program_from_file
+
+JUMP_OPS = {Op.JUMP_IF_TRUE, Op.JUMP_IF_FALSE}
+
+
+class Profiler:
+    """Counts and times instructions run by IntCode machines.
+
+    attach() replaces the machine's step() with one that records as it goes,
+    and detach() puts it back, so a machine that isn't being profiled pays
+    nothing.  Only run() goes through step(): run_gen() and run_compiled()
+    aren't profiled.
+
+    Recorded, per opcode and per instruction address: how many times it ran,
+    and the total seconds.  Also how many times each address was jumped to,
+    and how many steps were run at each relative base.
+    """
+    def __init__(self):
+        self.op_counts = collections.Counter()
+        self.op_times = collections.Counter()
+        self.addr_counts = collections.Counter()
+        self.addr_times = collections.Counter()
+        self.jump_targets = collections.Counter()
+        self.relbases = collections.Counter()
+
+    def attach(self, cpu):
+        real_step = type(cpu).step
+        clock = time.perf_counter
+
+        def step():
+            ip = cpu.ip
+            inst = cpu.decoded.get(ip) or cpu.decode(ip)
+            relbase = cpu.relbase
+            start = clock()
+            keep_going = real_step(cpu)
+            self.record(ip, inst, clock() - start, relbase, cpu.ip)
+            return keep_going
+
+        cpu.step = step
+
+    def detach(self, cpu):
+        del cpu.step
+
+    def record(self, ip, inst, seconds, relbase, next_ip):
+        op = inst.op.name
+        self.op_counts[op] += 1
+        self.op_times[op] += seconds
+        self.addr_counts[ip] += 1
+        self.addr_times[ip] += seconds
+        self.relbases[relbase] += 1
+        if inst.op in JUMP_OPS and next_ip != ip + inst.size:
+            self.jump_targets[next_ip] += 1
+
+    def as_json(self):
+        # JSON keys are strings, so addresses get converted.
+        return json.dumps({
+            "op_counts": self.op_counts,
+            "op_times": self.op_times,
+            "addr_counts": self.addr_counts,
+            "addr_times": self.addr_times,
+            "jump_targets": self.jump_targets,
+            "relbases": self.relbases,
+        }, indent=1)
+
+    def report(self, top=20):
+        """A text report, with the busiest things first."""
+        total_steps = sum(self.op_counts.values())
+        total_time = sum(self.op_times.values()) or 1
+        lines = [f"{total_steps} steps, {total_time:.3f}s"]
+
+        lines.append("\nBy opcode:")
+        for op, count in self.op_counts.most_common():
+            seconds = self.op_times[op]
+            lines.append(f"  {op:15} {count:12} {seconds:10.3f}s {100 * seconds / total_time:6.1f}%")
+
+        lines.append(f"\nTop {top} addresses by time:")
+        by_time = sorted(self.addr_times.items(), key=lambda at: at[1], reverse=True)
+        for addr, seconds in by_time[:top]:
+            count = self.addr_counts[addr]
+            lines.append(f"  {addr:8} {count:12} {seconds:10.3f}s {100 * seconds / total_time:6.1f}%")
+
+        lines.append(f"\nTop {top} jump targets:")
+        for addr, count in self.jump_targets.most_common(top):
+            lines.append(f"  {addr:8} {count:12}")
+
+        lines.append(f"\nTop {top} relative bases:")
+        for relbase, count in self.relbases.most_common(top):
+            lines.append(f"  {relbase:8} {count:12}")
+
+        return "\n".join(lines)
+
+
+def test_profiler():
+    # A loop that counts down from 3 in address 9, then stops.
+    program = [1001,9,-1,9, 1005,9,0, 99, 0, 3]
+    cpu = IntCode(program)
+    profiler = Profiler()
+    profiler.attach(cpu)
+    cpu.run()
+    assert profiler.op_counts == {"ADD": 3, "JUMP_IF_TRUE": 3, "STOP": 1}
+    assert sum(profiler.addr_counts.values()) == cpu.steps == 7
+    assert profiler.jump_targets == {0: 2}
+    assert profiler.relbases == {0: 7}
+    assert json.loads(profiler.as_json())["addr_counts"] == {"0": 3, "4": 3, "7": 1}
+    assert profiler.report().startswith("7 steps")
+
+    profiler.detach(cpu)
+    assert cpu.step.__func__ is IntCode.step
+
+def test_profiler_relbase():
+    # From day 9: a quine, which moves the relative base along.
+    program = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+    cpu = CagedIntCode(program, [])
+    profiler = Profiler()
+    profiler.attach(cpu)
+    cpu.run()
+    assert cpu.outputs == program
+    assert sorted(profiler.relbases) == list(range(17))
+
+
+if __name__ == "__main__":
+    # python intcode_profile.py program.txt [input ...]
+    cpu = CagedIntCode(program_from_file(sys.argv[1]), [int(v) for v in sys.argv[2:]])
+    profiler = Profiler()
+    profiler.attach(cpu)
+    cpu.run()
+    print(profiler.report())
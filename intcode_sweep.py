@@ -0,0 +1,105 @@
+# Run one IntCode program many times, in a pool of worker processes.
+
+import concurrent.futures
+import itertools
+import os
+
+import pytest
+
+from intcode import CagedIntCode, produces
+
+# The program, in each worker process.
+worker_program = None
+
+def init_worker(program):
+    global worker_program
+    worker_program = program
+
+def run_chunk(chunk, setup, run, collect):
+    results = []
+    for input_set in chunk:
+        mem, inputs = setup(worker_program, input_set)
+        results.append((input_set, collect(run(mem, inputs))))
+    return results
+
+def use_inputs(program, input_set):
+    """The default setup: run the program as-is, with input_set as its inputs."""
+    return program, input_set
+
+def run_caged(mem, inputs):
+    """The default run: a CagedIntCode, run until it stops."""
+    cpu = CagedIntCode(mem, inputs)
+    cpu.run()
+    return cpu
+
+def outputs(cpu):
+    """The default collect: all the outputs."""
+    return cpu.outputs
+
+def sweep(program, input_sets, collect=outputs, setup=use_inputs, run=run_caged, workers=None, chunk_size=500):
+    """Run `program` once for each of `input_sets`, in worker processes.
+
+    Yields (input_set, result) pairs as they finish, which is not necessarily
+    in order.  For each input set, `setup(program, input_set)` returns the
+    memory and inputs to run with, `run(mem, inputs)` runs them, and
+    `collect()` gets the result from what `run` returned, by default the
+    finished machine.  All three must be picklable: module-level functions.
+
+    Each run has to be worth sending to another process: for short programs,
+    give a cheaper `run` and a big `chunk_size`.
+
+    The program is sent to each worker once.  Input sets are taken from the
+    iterable a chunk at a time as workers need them, so stopping the
+    iteration early (to find the first match, for example) skips the rest.
+    """
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(program,),
+    ) as executor:
+        input_sets = iter(input_sets)
+        in_flight = set()
+
+        def submit_more():
+            while len(in_flight) < 2 * workers:
+                chunk = list(itertools.islice(input_sets, chunk_size))
+                if not chunk:
+                    break
+                in_flight.add(executor.submit(run_chunk, chunk, setup, run, collect))
+
+        try:
+            submit_more()
+            while in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+                    yield from future.result()
+                submit_more()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+# Is the input less than, equal to, or more than 8?  From day 5.
+LARGER_EXAMPLE = [
+    3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,
+    1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,
+    999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99,
+]
+
+def run_compiled(mem, inputs):
+    cpu = CagedIntCode(mem, inputs)
+    cpu.run_compiled()
+    return cpu
+
+@pytest.mark.parametrize("run", [run_caged, run_compiled])
+def test_sweep(run):
+    input_sets = [(i,) for i in range(-20, 20)]
+    results = dict(sweep(LARGER_EXAMPLE, input_sets, run=run, workers=2, chunk_size=7))
+    assert results == {inputs: produces(LARGER_EXAMPLE, inputs) for inputs in input_sets}
+
+def test_sweep_stops_early():
+    input_sets = ((i,) for i in range(1_000_000))
+    for inputs, outs in sweep(LARGER_EXAMPLE, input_sets, workers=2):
+        if outs == [1000]:
+            break
+    assert inputs == (8,)
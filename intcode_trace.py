@@ -0,0 +1,243 @@
+# Record an IntCode run to a file, and look at any point in it afterward.
+
+import bisect
+import collections
+import mmap
+import pickle
+import struct
+
+from intcode import CagedIntCode, IntCode, Memory, Op, OPS_BY_CODE, RELATIVE, WRITE_OPS
+
+# The file starts with a header: magic, version, record size, record count.
+HEADER = struct.Struct("<4sHHq")
+MAGIC = b"ICTR"
+VERSION = 1
+
+# One record per instruction: ip, next ip, relative base after, the address
+# written, the value written or output, the opcode, and flags.
+RECORD = struct.Struct("<qqqqqBB")
+TraceRecord = collections.namedtuple("TraceRecord", "ip, next_ip, relbase, addr, value, opcode, flags")
+
+WROTE = 1
+INPUT = 2
+OUTPUT = 4
+
+# Saved state to replay from: memory is the Memory's list, where its far
+# addresses start, and its far pages.
+Checkpoint = collections.namedtuple("Checkpoint", "index, steps, ip, relbase, image, far, pages")
+
+
+class Recorder:
+    """Write a trace of the instructions an IntCode machine runs.
+
+    attach() replaces the machine's step() with one that records, so only
+    run() is traced, not run_gen() or run_compiled().  Records go into a
+    memory-mapped file at `path`, which grows as needed.  Every
+    `checkpoint_every` records, the whole machine state is saved to
+    `path`.checkpoints, so a Replayer doesn't have to start from the
+    beginning.  Values must fit in 64 bits.
+
+    Use it as a context manager, or call close() when done.
+    """
+    GROW = 1 << 16
+
+    def __init__(self, path, checkpoint_every=100_000):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.count = 0
+        self.capacity = 0
+        self.file = open(path, "w+b")
+        self.map = None
+        self.grow()
+        self.checkpoints = open(path + ".checkpoints", "wb")
+        self.cpu = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def grow(self):
+        if self.map is not None:
+            self.map.close()
+        self.capacity += self.GROW
+        self.file.truncate(HEADER.size + self.capacity * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def attach(self, cpu):
+        real_step = type(cpu).step
+
+        def step():
+            ip = cpu.ip
+            inst = cpu.decoded.get(ip) or cpu.decode(ip)
+            relbase = cpu.relbase
+            op = inst.op
+            if self.count % self.checkpoint_every == 0:
+                self.checkpoint(cpu)
+            if op is Op.OUTPUT:
+                value = cpu.read(inst.params[0])
+            keep_going = real_step(cpu)
+            addr = 0
+            if op in WRITE_OPS:
+                mode, addr = inst.params[-1]
+                if mode == RELATIVE:
+                    addr += relbase
+                value = cpu.mem[addr]
+                flags = WROTE | (INPUT if op is Op.INPUT else 0)
+            elif op is Op.OUTPUT:
+                flags = OUTPUT
+            else:
+                value = 0
+                flags = 0
+            self.add(ip, cpu.ip, cpu.relbase, addr, value, op.value, flags)
+            return keep_going
+
+        self.cpu = cpu
+        cpu.step = step
+
+    def detach(self, cpu):
+        del cpu.step
+        self.cpu = None
+
+    def checkpoint(self, cpu):
+        mem = cpu.mem
+        checkpoint = Checkpoint(
+            self.count, cpu.steps, cpu.ip, cpu.relbase, *mem.get_state(),
+        )
+        pickle.dump(checkpoint, self.checkpoints)
+
+    def add(self, *fields):
+        if self.count == self.capacity:
+            self.grow()
+        try:
+            RECORD.pack_into(self.map, HEADER.size + self.count * RECORD.size, *fields)
+        except struct.error:
+            raise OverflowError(f"Can't trace values bigger than 64 bits: {fields}") from None
+        self.count += 1
+
+    def close(self):
+        if self.cpu is not None:
+            self.detach(self.cpu)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.count)
+        self.map.close()
+        self.file.truncate(HEADER.size + self.count * RECORD.size)
+        self.file.close()
+        self.checkpoints.close()
+
+
+class Replayer:
+    """Read a trace written by Recorder.
+
+    The records can be indexed like a list.  state_at() rebuilds the machine
+    as it was after any number of records, from the nearest checkpoint.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError(f"{path} isn't a version {VERSION} IntCode trace")
+        self.checkpoints = []
+        with open(path + ".checkpoints", "rb") as f:
+            while True:
+                try:
+                    self.checkpoints.append(pickle.load(f))
+                except EOFError:
+                    break
+        self.checkpoint_indexes = [c.index for c in self.checkpoints]
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(f"No record {index} in a trace of {self.count}")
+        return TraceRecord(*RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size))
+
+    def __iter__(self):
+        return (TraceRecord(*fields) for fields in RECORD.iter_unpack(memoryview(self.map)[HEADER.size:]))
+
+    def io_events(self):
+        """Yield (index, "input" or "output", value) for each I/O record."""
+        for index, record in enumerate(self):
+            if record.flags & INPUT:
+                yield index, "input", record.value
+            elif record.flags & OUTPUT:
+                yield index, "output", record.value
+
+    def state_at(self, index):
+        """An IntCode machine in the state it had after `index` records."""
+        if not 0 <= index <= self.count:
+            raise IndexError(f"No state {index} in a trace of {self.count}")
+        which = bisect.bisect_right(self.checkpoint_indexes, index) - 1
+        checkpoint = self.checkpoints[which]
+        cpu = IntCode([])
+        mem = cpu.mem = Memory.from_state((checkpoint.image, checkpoint.far, checkpoint.pages))
+        cpu.ip = checkpoint.ip
+        cpu.relbase = checkpoint.relbase
+        for i in range(checkpoint.index, index):
+            record = self[i]
+            if record.flags & WROTE:
+                mem[record.addr] = record.value
+            cpu.ip = record.next_ip
+            cpu.relbase = record.relbase
+        cpu.steps = checkpoint.steps + index - checkpoint.index
+        cpu.stopped = index > 0 and OPS_BY_CODE[self[index - 1].opcode][0] is Op.STOP
+        return cpu
+
+
+def machine_state(cpu):
+    return cpu.ip, cpu.relbase, cpu.steps, cpu.stopped, cpu.mem.dump(range(len(cpu.mem)))
+
+def test_record_and_replay(tmp_path):
+    # Read numbers, outputting the running total, kept in 22.  Also write to a
+    # far address, to exercise pages, and use the relative base.
+    program = [3,21, 1,21,22,22, 4,22, 21101,0,22,100000, 109,1, 1105,1,0, 0,0,0,0, 0,0]
+    path = str(tmp_path / "trace")
+    states = []
+
+    # Run a copy one step at a time to see what the states should be.
+    cpu = CagedIntCode(program, [1, 2, 3])
+    states.append(machine_state(cpu))
+    try:
+        while cpu.step():
+            states.append(machine_state(cpu))
+    except IndexError:
+        pass
+
+    cpu = CagedIntCode(program, [1, 2, 3])
+    with Recorder(path, checkpoint_every=4) as recorder:
+        recorder.attach(cpu)
+        try:
+            cpu.run()
+        except IndexError:
+            pass
+    assert cpu.outputs == [1, 3, 6]
+
+    replayer = Replayer(path)
+    assert len(replayer) == len(states) - 1
+    assert [(kind, value) for _, kind, value in replayer.io_events()] == [
+        ("input", 1), ("output", 1), ("input", 2), ("output", 3), ("input", 3), ("output", 6),
+    ]
+    for index in [0, 1, 3, 4, 5, 9, 17, len(replayer)]:
+        assert machine_state(replayer.state_at(index)) == states[index]
+    replayer.close()
+
+def test_replay_to_stop(tmp_path):
+    # From day 9: a quine.
+    program = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+    path = str(tmp_path / "trace")
+    cpu = CagedIntCode(program, [])
+    with Recorder(path, checkpoint_every=10) as recorder:
+        recorder.attach(cpu)
+        cpu.run()
+    replayer = Replayer(path)
+    assert [value for _, _, value in replayer.io_events()] == program
+    end = replayer.state_at(len(replayer))
+    assert machine_state(end) == machine_state(cpu)
+    assert end.stopped
+    replayer.close()